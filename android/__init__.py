@@ -1,3 +1,6 @@
+from . import adb
+from . import adbclient
+from . import daemon
 from . import util
 from . import project
 
@@ -5,7 +8,11 @@ from .adb import AndroidSelectDeviceCommand
 from .ant import AndroidAntBuildCommand
 from .ant import AndroidAntInstallCommand
 from .ant import AndroidAntRunCommand
+from .autocomplete import AndroidBuildCompletionIndexCommand
 from .autocomplete import AndroidXmlComplete
+from .gradle import AndroidGradleBuildCommand
+from .gradle import AndroidGradleInstallCommand
+from .gradle import AndroidGradleRunCommand
 from .listener import AndroidAuto
 from .listener import AndroidToggleAutoCommand
 from .sdk import AndroidAvdManagerCommand
@@ -17,5 +24,11 @@ from .sdk import AndroidCreateProjectListener
 from .sdk import AndroidUpdateProjectCommand
 from .sdk import AndroidInstallSupportLibrary
 from .settings import AndroidLoadSettingsCommand
-from .util import AndroidExecCommand
+from .tasks import AndroidExecCommand
 from .util import AndroidInstallRequiresCommand
+
+
+def plugin_unloaded():
+    adb.stop_registry()
+    adbclient.close_clients()
+    daemon.stop_daemons()
@@ -1,104 +1,384 @@
+import collections
+import concurrent.futures
 import os
-import re
-import subprocess
-import telnetlib
+import socket
+import threading
+import time
 import traceback
 
 import sublime
 import sublime_plugin
 
+from . import adbclient
 from . import project
 from .util import get_setting, logger
 
 log = logger(__name__)
 
 
-def get_devices():
-    """Gets a list of devices currently attached.
+# seconds allowed for probing a single device before it's marked unresponsive
+PROBE_TIMEOUT = 5
 
-    Querys `adb` from `get_sdk_dir()` for all emulator/device instances.
+# probes run concurrently across all attached devices
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+
+def get_adb(view=None):
+    return os.path.join(project.get_sdk_dir(view), "platform-tools", "adb")
+
+
+# properties read when probing a device, emulators report their avd name under
+# ro.boot.qemu.avd_name or, prior to android 7, ro.kernel.qemu.avd_name.
+PROBE_PROPS = [
+    "ro.product.model",
+    "ro.build.version.release",
+    "ro.boot.qemu.avd_name",
+    "ro.kernel.qemu.avd_name",
+]
+
+
+def get_props(adb, device, props, timeout=PROBE_TIMEOUT):
+    """Reads system properties of device in a single shell request.
+
+    Returns:
+        Dict of property names to values, empty strings for unset properties.
+    """
+    cmd = "; ".join("getprop {0}".format(prop) for prop in props)
+    out = adbclient.get_client(adb).shell(device, cmd, timeout)
+    lines = out.splitlines()
+    lines += [""] * (len(props) - len(lines))
+    return dict((prop, line.strip()) for prop, line in zip(props, lines))
+
+
+def probe_device(adb, device, timeout=PROBE_TIMEOUT):
+    """Gets name and os version of device.
+
+    Raises:
+        socket.timeout if device does not respond within timeout.
 
     Returns:
-        A tuple of lists. The first value is a list of device ids suitable for
-        use in selecting a device when calling adb. The second value is a list
-        of strings suitable for displaying text more descriptive to the use to
-        choose an appropriate device.
+        Tuple of (product, version).
+    """
+    props = get_props(adb, device, PROBE_PROPS, timeout)
+    product = props["ro.boot.qemu.avd_name"] or props["ro.kernel.qemu.avd_name"] or props["ro.product.model"]
+    version = props["ro.build.version.release"] or "x.x.x"
+    return product or "Unknown", version
+
+
+def describe_device(adb, device):
+    """Gets text describing device for display in a quick panel.
+
+    Never raises, devices that fail to respond are described as unresponsive.
     """
-    adb = os.path.join(project.get_sdk_dir(), "platform-tools", "adb")
-    cmd = [adb, "devices"]
     try:
-        proc = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE)
-        out, err = proc.communicate()
-    except:
-        sublime.error_message("Error trying to launch ADB:\n\n{0}\n\n{1}".format(cmd, traceback.format_exc()))
-        return
-    # get list of device ids
-    devices = []
-    out = str(out, "utf-8")
-    for line in out.split("\n"):
-        line = line.strip()
-        if line not in ["", "List of devices attached"]:
-            devices.append(re.sub(r"[ \t]*device$", "", line))
-    # build quick menu options displaying name, version, and device id
-    options = []
-    for device in devices:
-        # dump build.prop
-        cmd = [adb, "-s", device, "shell", "cat /system/build.prop"]
-        proc = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE)
-        build_prop = str(proc.stdout.read().strip(), "utf-8")
-        # get name
-        product = "Unknown"  # should never actually see this
-        if device.startswith("emulator"):
-            port = device.rsplit("-")[-1]
-            t = telnetlib.Telnet("localhost", port)
-            t.read_until(b"OK", 1000)
-            t.write(b"avd name\n")
-            product = str(t.read_until(b"OK", 1000), "utf-8")
-            t.close()
-            product = product.replace("OK", "").strip()
-        else:
-            product = re.findall(r"^ro\.product\.model=(.*)$", build_prop, re.MULTILINE)
-            if product:
-                product = product[0]
-        # get version
-        version = re.findall(r"ro\.build\.version\.release=(.*)$", build_prop, re.MULTILINE)
-        if version:
-            version = version[0]
-        else:
-            version = "x.x.x"
-        product = str(product).strip()
-        version = str(version).strip()
-        device = str(device).strip()
-        options.append("%s %s - %s" % (product, version, device))
+        product, version = probe_device(adb, device)
+    except (socket.error, adbclient.AdbError) as e:
+        log.warn("Device %s is unresponsive: %s", device, e)
+        return "Unresponsive - %s" % device
+    return "%s %s - %s" % (product, version, device)
+
+
+class DeviceRegistry(object):
+    """Live registry of attached devices.
+
+    Follows device connects and disconnects streamed by the adb server's
+    `track-devices` service from a background thread. Each device is probed once, when it first comes
+    online, and its description cached until it disconnects, so asking for
+    the current devices never starts a process.
+    """
+
+    def __init__(self, adb):
+        self.adb = adb
+        self.states = collections.OrderedDict()  # device id to adb state
+        self.descriptions = {}  # device id to probed description
+        self.listeners = []
+        self.waiting = []  # callbacks of `on_ready` waiting for the first device list
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.conn = None
+        self.stopped = False
+        self.quiet = False  # report giving up in the status bar instead of a dialog
+
+    def start(self):
+        t = threading.Thread(target=self.track)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.conn is not None:
+            self.conn.close()
+
+    def track(self):
+        """Follows devices until stopped.
+
+        Losing the adb server, such as while it restarts, is retried with a
+        growing delay. Tracking stops after TRACK_ATTEMPTS attempts in a row
+        fail without hearing from the server, reporting the error once, and
+        is started again by the next `get_registry()` with retry.
+        """
+        client = adbclient.get_client(self.adb)
+        failures = 0
+        while not self.stopped:
+            try:
+                self.conn = client.connect()
+                self.conn.sock.settimeout(None)
+                self.conn.request("host:track-devices")
+                while True:
+                    self.update(self.conn.read_hex())
+                    failures = 0
+            except (socket.error, adbclient.AdbError) as e:
+                if not self.stopped:
+                    failures += 1
+                    log.error("Tracking devices failed: %s", e)
+                    error = e
+            finally:
+                if self.conn is not None:
+                    self.conn.close()
+            with self.lock:
+                self.states.clear()
+            self.ready.clear()
+            if self.stopped:
+                break
+            if failures >= TRACK_ATTEMPTS:
+                self.stopped = True
+                if self.quiet:
+                    msg = "ADB: Failed to reach ADB server: {0}".format(error)
+                    sublime.set_timeout(lambda: sublime.status_message(msg), 0)
+                else:
+                    msg = "Error trying to reach ADB server:\n\n{0}".format(error)
+                    sublime.set_timeout(lambda: sublime.error_message(msg), 0)
+                break
+            # adb server restarting, give it a moment
+            time.sleep(min(TRACK_RETRY * 2 ** (failures - 1), TRACK_RETRY_MAX))
+
+    def update(self, msg):
+        """Applies a device list message from `adb track-devices`."""
+        states = collections.OrderedDict(adbclient.parse_devices(msg))
+
+        probe = []
+        with self.lock:
+            for device in list(self.descriptions):
+                if device not in states:
+                    del self.descriptions[device]
+            for device, state in states.items():
+                if state == "device" and device not in self.descriptions:
+                    self.descriptions[device] = None
+                    probe.append(device)
+            self.states = states
+        self.ready.set()
+
+        with self.lock:
+            waiting, self.waiting = self.waiting, []
+        for callback in waiting:
+            sublime.set_timeout(callback, 0)
+
+        for device in probe:
+            _pool.submit(self.probe, device)
+        self.notify(None)
+
+    def probe(self, device):
+        description = describe_device(self.adb, device)
+        with self.lock:
+            if device in self.descriptions:
+                self.descriptions[device] = description
+        self.notify(device)
 
-    return devices, options
+    def on_ready(self, callback):
+        """Calls callback on the main thread once adb has reported attached devices.
+
+        callback is called right away when devices are already known.
+        """
+        with self.lock:
+            if not self.ready.is_set():
+                self.waiting.append(callback)
+                return
+        callback()
+
+    def notify(self, device):
+        for listener in list(self.listeners):
+            try:
+                listener(device)
+            except Exception:
+                log.error(traceback.format_exc())
+
+    def get_devices(self):
+        """Gets attached devices.
+
+        Returns:
+            A tuple of lists. The first value is a list of device ids suitable
+            for use in selecting a device when calling adb. The second value is
+            a list of strings describing each device for display in a quick
+            panel, devices still being probed are described as such.
+        """
+        with self.lock:
+            devices = list(self.states)
+            options = []
+            for device, state in self.states.items():
+                if state != "device":
+                    options.append("%s - %s" % (state.title(), device))
+                elif self.descriptions.get(device, None) is None:
+                    options.append("Probing... - %s" % device)
+                else:
+                    options.append(self.descriptions[device])
+        return devices, options
+
+    def get_state(self, device):
+        """Gets adb state of device, such as `device` or `offline`, or None if not attached."""
+        return self.states.get(device, None)
+
+
+# seconds before tracking devices again after losing the adb server, doubled
+# after each attempt in a row that fails up to TRACK_RETRY_MAX.
+TRACK_RETRY = 2
+TRACK_RETRY_MAX = 30
+
+# attempts in a row failing to reach the adb server before tracking gives up
+TRACK_ATTEMPTS = 5
+
+_registry = None
+
+
+def get_registry(adb=None, retry=True):
+    """Gets the shared DeviceRegistry, starting it if needed.
+
+    The registry is restarted if the adb binary changes, such as when
+    switching to a project using a different sdk.
+
+    Args:
+        retry: restart the registry if it gave up on reaching the adb server.
+            Used by explicit requests for devices, while warming up passes
+            False. Until an explicit request, failing to reach the adb server
+            is reported in the status bar rather than a dialog.
+    """
+    global _registry
+    adb = adb or get_adb()
+    if _registry is None or _registry.adb != adb or (retry and _registry.stopped):
+        if _registry is not None:
+            _registry.stop()
+        _registry = DeviceRegistry(adb)
+        _registry.quiet = not retry
+        _registry.start()
+    elif retry:
+        _registry.quiet = False
+    return _registry
+
+
+def stop_registry():
+    global _registry
+    if _registry is not None:
+        _registry.stop()
+        _registry = None
 
 
 class AndroidSelectDeviceCommand(sublime_plugin.WindowCommand):
+    """Prompts to select a device, then runs commands with the device selected.
+
+    Devices come from the DeviceRegistry, so the quick panel opens without
+    running adb. Rows of devices still being probed fill in as they respond.
+
+    When more than one device is online, the first row selects all of them
+    and commands are run with a `devices` list instead of a single `device`.
+    """
+
     def is_visible(self):
         return False
 
     def run(self, callbacks, opts={}):
-        self.callbacks = callbacks
-        self.opts = opts
+        registry = get_registry()
+        # devices are known right away once the registry is running, such as
+        # after opening a file of the project. Otherwise wait on adb without
+        # blocking the ui, a later run supersedes a request still waiting.
+        self.request = request = object()
+
+        def on_ready():
+            if self.request is request:
+                self.request = None
+                self.select(registry, callbacks, opts)
+
+        def on_timeout():
+            if self.request is request:
+                self.request = None
+                sublime.status_message("ADB: Timed out listing devices!")
+
+        registry.on_ready(on_ready)
+        if self.request is request:
+            sublime.set_timeout(on_timeout, PROBE_TIMEOUT * 1000)
 
-        devices, options = get_devices()
-        self.devices = devices
+    def select(self, registry, callbacks, opts):
+        self.callbacks = callbacks
+        self.opts = dict(opts)
+        self.registry = registry
+        self.devices, self.options = registry.get_devices()
+        self.online = None
 
-        if len(options) == 0:
+        if len(self.devices) == 0:
             sublime.status_message("ADB: No device attached!")
-        elif len(options) == 1 and get_setting("sublimeandroid_device_select_default", True):
+        elif len(self.devices) == 1 and get_setting("sublimeandroid_device_select_default", True):
             self.on_done(0)  # run default
         else:
-            self.window.show_quick_panel(options, self.on_done)
+            self.selected = 0
+            self.generation = 0
+            registry.listeners.append(self.on_probe)
+            self.show()
+
+    def show(self):
+        # showing the panel again replaces the current one, which reports -1 to
+        # its on_done. generation ignores that from replaced panels.
+        self.generation += 1
+        generation = self.generation
+
+        def on_done(picked):
+            if generation == self.generation:
+                self.open = False
+                self.registry.listeners.remove(self.on_probe)
+                self.on_done(picked)
+
+        # rows map to self.devices offset by the all devices row, if any, of the
+        # panel last shown.
+        self.online = self.get_online()
+        options = list(self.options)
+        if self.online:
+            options.insert(0, "All devices ({0})".format(len(self.online)))
+        self.open = True
+        self.window.show_quick_panel(options, on_done, 0, self.selected, self.on_highlight)
+
+    def get_online(self):
+        """Gets devices that can be selected together, None if there's only one."""
+        online = [d for d in self.devices if self.registry.get_state(d) == "device"]
+        if len(online) < 2:
+            return None
+        return online
+
+    def on_highlight(self, picked):
+        self.selected = picked
+
+    def on_probe(self, device):
+        def update():
+            devices, options = self.registry.get_devices()
+            # only refresh descriptions; rows don't move while the panel is open
+            for i, d in enumerate(self.devices):
+                if d in devices:
+                    self.options[i] = options[devices.index(d)]
+                else:
+                    self.options[i] = "Disconnected - %s" % d
+            if self.open:
+                self.show()
+        sublime.set_timeout(update, 0)
 
     def on_done(self, picked):
         if picked == -1:
             return
 
-        device = self.devices[picked]
-        self.opts["device"] = device
-        log.debug("selected device is %s", device)
+        if self.online and picked == 0:
+            self.opts["devices"] = self.online
+            log.debug("selected devices are %s", self.online)
+        else:
+            if self.online:
+                picked -= 1
+            device = self.devices[picked]
+            self.opts["device"] = device
+            log.debug("selected device is %s", device)
 
         for callback in self.callbacks:
             self.window.run_command(callback, self.opts)
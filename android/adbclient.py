@@ -0,0 +1,352 @@
+import hashlib
+import os
+import re
+import socket
+import stat
+import struct
+import subprocess
+import threading
+import time
+
+from .util import logger
+
+log = logger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5037
+
+# largest payload of a single sync DATA packet
+SYNC_DATA_MAX = 64 * 1024
+
+
+class AdbError(Exception):
+    """Raised when the adb server reports a failure or the connection breaks."""
+
+
+class Connection(object):
+    """A single connection to the adb server."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def read(self, n):
+        """Reads exactly n bytes."""
+        buf = b""
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise AdbError("Connection closed by adb server")
+            buf += chunk
+        return buf
+
+    def read_all(self):
+        """Reads until the server closes the connection, yielding each chunk."""
+        while True:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                return
+            yield chunk
+
+    def read_hex(self):
+        """Reads a length prefixed string as sent by host services."""
+        n = int(self.read(4), 16)
+        return str(self.read(n), "utf-8", "replace")
+
+    def request(self, service):
+        """Sends a host service request and checks its status."""
+        data = service.encode("utf-8")
+        self.send("{0:04x}".format(len(data)).encode("ascii") + data)
+        status = self.read(4)
+        if status == b"FAIL":
+            raise AdbError(self.read_hex())
+        if status != b"OKAY":
+            raise AdbError("Unexpected response from adb server: {0!r}".format(status))
+
+    def sync_send(self, cmd, arg):
+        """Sends a sync request with a 32-bit little endian argument."""
+        self.send(cmd + struct.pack("<I", arg))
+
+    def sync_status(self):
+        status, n = struct.unpack("<4sI", self.read(8))
+        if status == b"FAIL":
+            raise AdbError(str(self.read(n), "utf-8", "replace"))
+        if status != b"OKAY":
+            raise AdbError("Unexpected sync response: {0!r}".format(status))
+
+
+class AdbClient(object):
+    """Client of the adb server's host protocol.
+
+    Talks to the adb server over TCP instead of running the `adb` binary for
+    each operation. See `SERVICES.TXT` and `SYNC.TXT` in the adb source for a
+    description of the protocol.
+
+    Each host protocol service consumes its connection, so a fresh connection
+    is opened per request; on a local socket that is far cheaper than
+    starting a process. Sync sessions however can serve many transfers, so
+    those are pooled per device and reused by later pushes.
+
+    Args:
+        adb: path of adb binary used to start the server if it's not running.
+            The server is not started when None, which is useful for testing
+            against a fake server.
+    """
+
+    def __init__(self, adb=None, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=10):
+        self.adb = adb
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sync_pool = {}  # device id to list of idle sync connections
+        # (device id, package) to tuple of (apk path, (mtime, size), lastUpdateTime)
+        # of the last install known to match the package installed on device.
+        self.installed = {}
+        self.lock = threading.Lock()
+
+    def connect(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout)
+        except socket.error:
+            if self.adb is None:
+                raise
+            self.start_server()
+            sock = socket.create_connection((self.host, self.port), timeout)
+        return Connection(sock)
+
+    def start_server(self):
+        log.info("Starting adb server")
+        subprocess.call([self.adb, "start-server"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def transport(self, device, timeout=None):
+        """Opens a connection routed to device."""
+        conn = self.connect(timeout)
+        try:
+            conn.request("host:transport:{0}".format(device))
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def devices(self):
+        """Gets attached devices.
+
+        Returns:
+            List of tuples of (device id, state).
+        """
+        conn = self.connect()
+        try:
+            conn.request("host:devices")
+            return parse_devices(conn.read_hex())
+        finally:
+            conn.close()
+
+    def shell_stream(self, device, cmd, timeout=None, wait=False):
+        """Runs a shell command on device.
+
+        Args:
+            timeout: seconds to wait for the connection and each read of
+                output, defaults to the client's timeout.
+            wait: wait on output without a timeout once the command has
+                started, for commands that may stay quiet for a long time
+                such as `pm install` while dexopt runs.
+
+        Yields:
+            bytes of output as it arrives.
+        """
+        conn = self.transport(device, timeout)
+        try:
+            conn.request("shell:{0}".format(cmd))
+            if wait:
+                conn.sock.settimeout(None)
+            for chunk in conn.read_all():
+                yield chunk
+        finally:
+            conn.close()
+
+    def shell(self, device, cmd, timeout=None):
+        """Runs a shell command on device.
+
+        Returns:
+            str of output.
+        """
+        return str(b"".join(self.shell_stream(device, cmd, timeout)), "utf-8", "replace")
+
+    def get_sync(self, device, pooled=True):
+        if pooled:
+            with self.lock:
+                idle = self.sync_pool.get(device, [])
+                if idle:
+                    return idle.pop()
+        conn = self.transport(device)
+        try:
+            conn.request("sync:")
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def put_sync(self, device, conn):
+        with self.lock:
+            self.sync_pool.setdefault(device, []).append(conn)
+
+    def push(self, device, local, remote, mode=0o644, pooled=True):
+        """Copies a local file to device over a pooled sync session.
+
+        A pooled session that has gone stale, such as after the device
+        reconnected, is discarded and the push retried on a new session.
+        """
+        conn = self.get_sync(device, pooled)
+        try:
+            path = "{0},{1}".format(remote, stat.S_IFREG | mode).encode("utf-8")
+            conn.sync_send(b"SEND", len(path))
+            conn.send(path)
+            with open(local, "rb") as f:
+                while True:
+                    data = f.read(SYNC_DATA_MAX)
+                    if not data:
+                        break
+                    conn.sync_send(b"DATA", len(data))
+                    conn.send(data)
+            conn.sync_send(b"DONE", int(os.path.getmtime(local)))
+            conn.sync_status()
+        except socket.error:
+            conn.close()
+            if not pooled:
+                raise
+            return self.push(device, local, remote, mode, pooled=False)
+        except:
+            conn.close()
+            raise
+        self.put_sync(device, conn)
+
+    def get_package(self, device, package):
+        """Gets the installed apk of package and the time it was last updated.
+
+        Returns:
+            Tuple of (apk path, lastUpdateTime), None if package is not
+            installed or is split over more than one apk.
+        """
+        out = self.shell(device, "pm path {0}".format(package))
+        paths = [line[len("package:"):].strip() for line in out.splitlines() if line.startswith("package:")]
+        if len(paths) != 1:
+            return None
+        out = self.shell(device, "dumpsys package {0}".format(package))
+        m = re.search(r"lastUpdateTime=([^\r\n]+)", out)
+        return paths[0], m.group(1).strip() if m is not None else None
+
+    def checksum(self, device, path):
+        """Gets a checksum of a file on device.
+
+        Returns:
+            Tuple of (hashlib algorithm name, hex digest), None if device has
+            no checksum tool.
+        """
+        for algorithm in ["md5", "sha1"]:
+            out = self.shell(device, "{0}sum '{1}'".format(algorithm, path))
+            m = re.match(r"\s*([0-9a-fA-F]+)\s", out)
+            if m is not None and len(m.group(1)) == hashlib.new(algorithm).digest_size * 2:
+                return algorithm, m.group(1).lower()
+        return None
+
+    def is_installed(self, device, apk, package):
+        """Checks if apk is byte for byte the apk installed for package on device.
+
+        The result of comparing checksums is remembered until apk changes or
+        the package is updated on device, such as by an install outside of
+        the plugin.
+        """
+        st = os.stat(apk)
+        stamp = (st.st_mtime, st.st_size)
+        info = self.get_package(device, package)
+        if info is None:
+            return False
+        path, updated = info
+        key = (device, package)
+        if updated is not None and self.installed.get(key, None) == (apk, stamp, updated):
+            return True
+        remote = self.checksum(device, path)
+        if remote is None:
+            return False
+        h = hashlib.new(remote[0])
+        with open(apk, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                h.update(chunk)
+        if h.hexdigest() != remote[1]:
+            return False
+        self.installed[key] = (apk, stamp, updated)
+        return True
+
+    def install(self, device, apk, reinstall=True, package=None):
+        """Installs apk on device, same as `adb install`.
+
+        Args:
+            package: package name of apk. When given, the install is skipped
+                if the same apk is already installed.
+
+        Yields:
+            bytes of progress and `pm install` output.
+        """
+        if package is not None and self.is_installed(device, apk, package):
+            yield "{0} is up to date, skipping install\n".format(os.path.basename(apk)).encode("utf-8")
+            return
+        remote = "/data/local/tmp/{0}".format(os.path.basename(apk))
+        start = time.time()
+        self.push(device, apk, remote)
+        size = os.path.getsize(apk)
+        elapsed = max(time.time() - start, 0.001)
+        yield "{0} KB/s ({1} bytes in {2:.3f}s)\n".format(int(size / 1024 / elapsed), size, elapsed).encode("utf-8")
+        cmd = "pm install {0}'{1}'".format("-r " if reinstall else "", remote)
+        out = b"".join(self.shell_stream(device, cmd, wait=True))
+        self.shell(device, "rm '{0}'".format(remote))
+        yield out
+        if b"Success" not in out:
+            raise AdbError("Install failed")
+        if package is not None:
+            info = self.get_package(device, package)
+            if info is not None and info[1] is not None:
+                self.installed[(device, package)] = (apk, (os.path.getmtime(apk), size), info[1])
+
+    def close(self):
+        with self.lock:
+            for conns in self.sync_pool.values():
+                for conn in conns:
+                    try:
+                        conn.sync_send(b"QUIT", 0)
+                    except socket.error:
+                        pass
+                    conn.close()
+            self.sync_pool = {}
+
+
+def parse_devices(data):
+    devices = []
+    for line in data.split("\n"):
+        if "\t" in line:
+            device, state = line.strip().split("\t", 1)
+            devices.append((device, state))
+    return devices
+
+
+_clients = {}
+
+
+def get_client(adb):
+    """Gets shared AdbClient using adb binary to start the server when needed."""
+    client = _clients.get(adb, None)
+    if client is None:
+        client = _clients[adb] = AdbClient(adb)
+    return client
+
+
+def close_clients():
+    """Closes pooled connections of every shared AdbClient."""
+    for client in _clients.values():
+        client.close()
+    _clients.clear()
@@ -1,26 +1,30 @@
 import os
-import re
-from xml.etree import ElementTree as ET
 
+import sublime
 import sublime_plugin
 
+from . import antfile
+from . import fingerprint
 from . import project
+from . import tasks
 from .util import get_setting, logger
 
 log = logger(__name__)
 
 
-def get_project_name():
-    """Get ant project name.
+def get_build(path=None):
+    """Gets targets of an android project's build.xml.
 
-    Parsed from the android project's build.xml file.
+    Args:
+        path: android project path, defaults to that of the active view.
+
+    Returns:
+        AntBuild
     """
-    p = project.get_path()
-    root = ET.parse(os.path.join(p, "build.xml")).getroot()
-    name = root.attrib.get("name", None)
-    if name is None:
-        log.error("Failed to get project name from build.xml")
-    return name
+    if path is None:
+        path = project.get_path()
+    sdk_dir = get_setting("sublimeandroid_sdk_dir", "") or project.get_project_at(path).sdk_dir
+    return antfile.get_build(os.path.join(path, "build.xml"), sdk_dir)
 
 
 class AndroidAntBuildCommand(sublime_plugin.WindowCommand):
@@ -28,11 +32,22 @@ class AndroidAntBuildCommand(sublime_plugin.WindowCommand):
 
     Parses the project's build.xml including any imports specified to locate all
     build targets and then provides a quick panel for selecting the desired target.
+    Targets are cached until any of the files involved change.
+
+    Args:
+        target: ant target to run without prompting.
+        quiet: don't show output panel unless the build fails.
+        skip_unchanged: skip build if the project's sources are unchanged
+            since the last successful build of target.
+        tag: tag of the build task, see `android_exec`.
+        path: android project to build, defaults to that of the active view.
+            Callers running the command later, such as auto build, pass the
+            project so switching views meanwhile doesn't change it.
     """
 
-    def run(self, target=None, quiet=False):
-        build_xml = os.path.join(project.get_path(), "build.xml")
-        self.targets = self.get_targets(build_xml)
+    def run(self, target=None, quiet=False, skip_unchanged=False, tag="build", path=None):
+        self.path = path or project.get_path()
+        self.targets = get_build(self.path).targets
 
         options = ["Build, Install, Run"]
         for k in sorted(self.targets):
@@ -40,7 +55,7 @@ class AndroidAntBuildCommand(sublime_plugin.WindowCommand):
 
         log.info("Received target %s", target)
         if target in self.targets:
-            self.build(target, quiet=quiet)
+            self.build(target, quiet=quiet, skip_unchanged=skip_unchanged, tag=tag)
         else:
             self.window.show_quick_panel(options, self.on_done)
 
@@ -59,62 +74,30 @@ class AndroidAntBuildCommand(sublime_plugin.WindowCommand):
 
         self.build(target, install_and_run=install_and_run)
 
-    def build(self, target, quiet=False, install_and_run=False):
-        opts = {
-            "cmd": ["ant", target],
-            "quiet": True,
-            "working_dir": project.get_path()
-        }
-        self.window.run_command("android_exec", opts)
-
-        if install_and_run:
-            log.debug("target is %s and calling install and run.", target)
-            self.window.run_command("android_select_device", {"callbacks": ["android_ant_install", "android_ant_run"]})
-
-    def get_targets(self, path, targets={}):
-        """Gets list of ANT targets
-
-        Recursively search given file and contained imports for ant targets.
+    def build(self, target, quiet=False, install_and_run=False, skip_unchanged=False, tag="build"):
+        path = self.path
+        fingerprint.compute_async(path, project.get_project_at(path).android_libs,
+                                  lambda fp: self.start(path, target, fp, quiet, install_and_run, skip_unchanged, tag))
 
-        Returns:
-            A dict containing keys of all ANT targets and values being the target's
-            description.
-        """
-        log.debug("checking path: %s", path)
-        # return in cases where path is not valid. this may occur when the build.xml
-        # stubs imports for custom rules that may not have been implemented.
-        if not os.path.isfile(path):
+    def start(self, path, target, fp, quiet, install_and_run, skip_unchanged, tag):
+        if skip_unchanged and fingerprint.is_up_to_date(path, target, fp):
+            log.debug("Skipping %s build of %s", target, path)
+            sublime.status_message("Android: {0} build skipped, up to date".format(target))
             return
 
-        root = ET.parse(path).getroot()
-
-        for target in root.getiterator("target"):
-            name = target.attrib["name"]
-            desc = target.attrib.get("description", "")[:100]
-
-            # TODO skip targets with ant vars for now
-            if re.search("\${.*}", name) is not None:
-                continue
-
-            if not name.startswith("-") and name not in targets:
-                targets[name] = desc
-
-        for imp in root.getiterator("import"):
-            f = imp.attrib["file"]
-            # check for paths with a reference to ${sdk.dir}
-            #
-            # TODO should load property files for more complex build.xml files
-            # to determine appropriate paths with referenced ant vars.
-            log.debug("found import with file attr: %s", f)
-            if f.startswith("${sdk.dir"):
-                f = f.replace("${sdk.dir}", project.get_sdk_dir())
+        def on_done(task):
+            if task.state == tasks.DONE:
+                fingerprint.record(path, target, fp)
 
-            if not os.path.isabs(f):
-                f = os.path.join(project.get_path(), f)
+        fingerprint.forget(path)
+        task = tasks.Task("ant {0}".format(target), cmd=["ant", target], working_dir=path,
+                          daemon=get_setting("sublimeandroid_build_daemon", None),
+                          tag=tag, quiet=quiet, callback=on_done)
+        tasks.get_scheduler(self.window).submit(task)
 
-            self.get_targets(f, targets)
-
-        return targets
+        if install_and_run:
+            log.debug("target is %s and calling install and run.", target)
+            self.window.run_command("android_select_device", {"callbacks": ["android_ant_install", "android_ant_run"]})
 
     def is_visible(self):
         return project.exists()
@@ -123,34 +106,57 @@ class AndroidAntBuildCommand(sublime_plugin.WindowCommand):
         return project.exists()
 
 
+def get_devices(device=None, devices=None):
+    """Gets list of devices from the arguments given by `android_select_device`."""
+    if devices:
+        return devices
+    return [device]
+
+
 class AndroidAntInstallCommand(sublime_plugin.WindowCommand):
     """Install target apk based on sdk's ant build.xml"""
-    def run(self, device=None, target="debug"):
-        # TODO if device is None, run android_select_device and come back here.
-        if device is None:
-            self.window.run_command("android_select_device", {"target": target})
+    def run(self, device=None, devices=None, target="debug"):
+        if device is None and not devices:
+            self.window.run_command("android_select_device", {"callbacks": ["android_ant_install"], "opts": {"target": target}})
             return
 
         adb = os.path.join(project.get_sdk_dir(), "platform-tools", "adb")
-        name = "{0}-{1}.apk".format(get_project_name(), target)
-        apk = os.path.join(project.get_path(), "bin", name)
-
-        opts = {
-            "cmd": [adb, "-s", device, "install", "-r", apk],
-            "working_dir": project.get_path()
+        step = {
+            "install_from": [os.path.join(project.get_path(), "bin")],
+            "pattern": "*-{0}.apk".format(target),
+            "package": project.get_package()
         }
-        self.window.run_command("android_exec", opts)
+
+        # each device installs once the pending build, if any, completes.
+        for device in get_devices(device, devices):
+            opts = {
+                "adb": {"adb": adb, "device": device, "steps": [step]},
+                "name": "install {0}".format(device),
+                "tag": "install:{0}".format(device),
+                "after": ["build"],
+                "working_dir": project.get_path()
+            }
+            self.window.run_command("android_exec", opts)
 
 
 class AndroidAntRunCommand(sublime_plugin.WindowCommand):
-    def run(self, device):
+    def run(self, device=None, devices=None, target=None):
+        if device is None and not devices:
+            self.window.run_command("android_select_device", {"callbacks": ["android_ant_run"]})
+            return
+
         adb = os.path.join(project.get_sdk_dir(), "platform-tools", "adb")
         activity = get_setting("sublimeandroid_default_activity", "")
         if not activity:
             activity = project.get_activity_main()
 
-        opts = {
-            "cmd": [adb, "-s", device, "shell", "am", "start", "-n", activity],
-            "working_dir": project.get_path()
-        }
-        self.window.run_command("android_exec", opts)
+        # a device that fails to install is skipped without affecting the others.
+        for device in get_devices(device, devices):
+            opts = {
+                "adb": {"adb": adb, "device": device, "steps": [{"shell": ["am", "start", "-n", activity]}]},
+                "name": "run {0}".format(device),
+                "tag": "run:{0}".format(device),
+                "after": ["build", "install:{0}".format(device)],
+                "working_dir": project.get_path()
+            }
+            self.window.run_command("android_exec", opts)
@@ -0,0 +1,162 @@
+import os
+import re
+from xml.etree import ElementTree as ET
+
+from . import project
+from .util import logger
+
+log = logger(__name__)
+
+# properties files of an android project in the order ant loads them. As
+# ant properties can't be redefined, earlier files take precedence.
+PROPERTY_FILES = ["local.properties", "ant.properties", "build.properties", "project.properties"]
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class Properties(object):
+    """Ant properties, where the first definition of a name wins as in ant."""
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, name, value):
+        if name not in self.values:
+            self.values[name] = value
+
+    def expand(self, text, seen=()):
+        """Expands `${name}` references in text, leaving undefined ones as is."""
+        def repl(m):
+            name = m.group(1)
+            if name not in self.values or name in seen:
+                return m.group(0)
+            return self.expand(self.values[name], seen + (name,))
+        return re.sub(r"\$\{([^}]*)\}", repl, text)
+
+
+class AntBuild(object):
+    """Targets of an ant build file and every file it imports.
+
+    Evaluates the `property`, `loadproperties` and `import` elements of each
+    build file in document order, so imports and target names that reference
+    properties, such as `${sdk.dir}/tools/ant/build.xml`, are resolved the
+    same way ant resolves them.
+
+    Attributes:
+        targets: dict of public target names to descriptions. Targets of a
+            build file take precedence over those of files it imports.
+        stamps: dict of every file read, including missing imports and
+            properties files, to its mtime or None if it doesn't exist.
+    """
+
+    def __init__(self, build_xml, sdk_dir=None):
+        self.build_xml = build_xml
+        self.sdk_dir = sdk_dir
+        self.basedir = os.path.dirname(build_xml)
+        self.stamps = {}
+        self.props = Properties()
+        self.props.set("basedir", self.basedir)
+        self.props.set("ant.file", build_xml)
+        if sdk_dir:
+            self.props.set("sdk.dir", sdk_dir)
+        for name in PROPERTY_FILES:
+            self.load_properties(os.path.join(self.basedir, name))
+        self.targets = self.parse(build_xml)
+
+    def is_fresh(self):
+        """Checks if none of the files read have changed."""
+        return all(get_mtime(path) == mtime for path, mtime in self.stamps.items())
+
+    def resolve(self, path, relative_to):
+        path = self.props.expand(path)
+        if "${" in path:
+            log.debug("Unresolved property in %s", path)
+            return None
+        return os.path.normpath(os.path.join(relative_to, path))
+
+    def load_properties(self, path, prefix=""):
+        self.stamps[path] = get_mtime(path)
+        if self.stamps[path] is None:
+            return
+        for name, value in project.parse_properties(path).items():
+            self.props.set(prefix + name, value)
+
+    def parse(self, path):
+        """Evaluates build file at path and its imports.
+
+        Returns:
+            Dict of target names to descriptions.
+        """
+        log.debug("Parsing ant file %s", path)
+        self.stamps[path] = get_mtime(path)
+        # missing files are recorded above as stubbed custom rules may be
+        # created later.
+        if self.stamps[path] is None:
+            return {}
+        try:
+            root = ET.parse(path).getroot()
+        except ET.ParseError as e:
+            log.warn("Skipping ant file %s: %s", path, e)
+            return {}
+
+        folder = os.path.dirname(path)
+        targets = {}
+        imported = {}
+        for el in root:
+            if el.tag == "property":
+                self.eval_property(el)
+            elif el.tag == "loadproperties" and "srcFile" in el.attrib:
+                f = self.resolve(el.attrib["srcFile"], self.basedir)
+                if f is not None:
+                    self.load_properties(f, el.attrib.get("prefix", ""))
+            elif el.tag == "import" and "file" in el.attrib:
+                # imports are relative to the importing file, not basedir
+                f = self.resolve(el.attrib["file"], folder)
+                if f is not None:
+                    for name, desc in self.parse(f).items():
+                        imported.setdefault(name, desc)
+            elif el.tag == "target" and "name" in el.attrib:
+                name = self.props.expand(el.attrib["name"])
+                if "${" not in name and not name.startswith("-"):
+                    targets[name] = self.props.expand(el.attrib.get("description", ""))[:100]
+
+        imported.update(targets)
+        return imported
+
+    def eval_property(self, el):
+        attrib = el.attrib
+        if "name" in attrib:
+            if "value" in attrib:
+                self.props.set(attrib["name"], self.props.expand(attrib["value"]))
+            elif "location" in attrib:
+                location = self.resolve(attrib["location"], self.basedir)
+                if location is not None:
+                    self.props.set(attrib["name"], location)
+        elif "file" in attrib:
+            f = self.resolve(attrib["file"], self.basedir)
+            if f is not None:
+                self.load_properties(f, attrib.get("prefix", ""))
+        elif "environment" in attrib:
+            for name, value in os.environ.items():
+                self.props.set("{0}.{1}".format(attrib["environment"], name), value)
+
+
+# map build.xml paths to AntBuild
+_builds = {}
+
+
+def get_build(build_xml, sdk_dir=None):
+    """Gets targets of build_xml, only parsing it again once any file involved changes.
+
+    Returns:
+        AntBuild
+    """
+    build = _builds.get(build_xml, None)
+    if build is None or build.sdk_dir != sdk_dir or not build.is_fresh():
+        build = _builds[build_xml] = AntBuild(build_xml, sdk_dir)
+    return build
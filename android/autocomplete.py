@@ -1,11 +1,13 @@
-import os
 import re
-from xml.etree import ElementTree as ET
+import threading
 
 import sublime
 import sublime_plugin
 
+from . import index
 from . import project
+from . import resources
+from . import xmlcontext
 
 
 class AndroidXmlComplete(sublime_plugin.EventListener):
@@ -16,79 +18,91 @@ class AndroidXmlComplete(sublime_plugin.EventListener):
         if not self.is_responsible(view):
             return
 
-        if not hasattr(self, "lookup"):
-            self.load_lookup()
+        idx = index.get(project.get_sdk_dir(view), project.get_target_platform(view))
+        if idx is None:
+            return  # still loading in background, don't block typing
 
-        line = view.substr(sublime.Region(view.full_line(locations[0]).begin(), locations[0])).strip()
-        if line == "<":
-            keys = [(k, k) for k in list(self.lookup.keys()) if k.lower().startswith(prefix.lower())]
+        ctx = xmlcontext.get(view).context(view, locations[0])
+        # right after `<` no tag name is read yet, complete every tag
+        if (ctx.mode == xmlcontext.TAG_NAME and ctx.tag == prefix) or (ctx.mode == xmlcontext.LT and not prefix):
+            keys = [(k, k) for k in idx.find_tags(prefix)]
             return (keys, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS)
 
-        part = line.rsplit(" ")[-1].strip()  # BUG this would flunk on string values with spaces
-        data = view.substr(sublime.Region(0, locations[0] - len(prefix)))
-        idx = data.rfind("<")
-        el = re.search("<([[a-zA-Z0-9\.]*)[ \n\r]", data[idx:]).groups()[0].strip()
-
-        if part.lower() == "android:":
-            keys = []
-            # TODO cache all this searching during initial load
-            # match el and el_*
-            for e in self.match_keys(el):
-                keys += [(k, "%s=\"$0\"" % k) for k in list(self.lookup[e].keys())]
-
-            for parent in self.widgets[el]:
-                for e in self.match_keys(parent):
-                    keys += [(k, "%s=\"$0\"" % k) for k in list(self.lookup[e].keys())]
-            #
-
+        el = ctx.tag
+        ns, _, name = ctx.attr.rpartition(":")
+        if ctx.mode == xmlcontext.ATTR_NAME and ns and name.lower() == prefix.lower():
+            keys = [(k, "%s=\"$0\"" % k) for k in self.get_attributes(view, idx, el, ns)]
             self.dirty = True  # trigger to provide further completions to value
-            keys.sort()
-            return (set(keys), sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS)
+            return (keys, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS)
 
         # set `dirty = False` here after providing initial autocomplete for dirty
         self.dirty = False
-        srch = re.search(":(.*)=", part)
-        if not srch:
+        if ctx.mode != xmlcontext.VALUE:
             return
-        groups = srch.groups()
-        if not groups:
+
+        # references are valid in attributes of any namespace, even none such
+        # as `style` or `layout` of `include`.
+        line = view.substr(sublime.Region(view.line(locations[0]).begin(), locations[0]))
+        value = line[line.rfind(ctx.extra) + 1:]
+        if value.startswith("@"):
+            return self.get_references(view, value, prefix)
+        if not ns:
             return
-        attr = groups[0]
-        # need to iter through all possible keys to find attr def
-        # TODO cache all this searching during initial load
-        for e in self.match_keys(el):
-            if attr in self.lookup[e] and self.lookup[e][attr]:
-                keys = [(k, k) for k in self.lookup[e][attr]]
-                return (keys, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS)
-        for parent in self.widgets[el]:
-            for e in self.match_keys(parent):
-                if attr in self.lookup[e] and self.lookup[e][attr]:
-                    keys = [(k, k) for k in self.lookup[e][attr]]
-                    return (keys, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS)
-        # TODO provide completions based on custom attrs defined within project
-
-    def match_keys(self, key):
-        """Matches a given key to other versions of the same type.
-
-        The SDK data files segment items based on certain types of groups. For
-        example, `ViewGroup` also has an entry for `ViewGroup_MarginLayout`.
-        We don't want to provide tag completion for `ViewGroup_MarginLayout` as
-        that's not a valid tag, but we do want to be able to lookup all keys
-        that are associated with `ViewGroup`.
-
-        Returns:
-            List of strings where each value maps to self.lookup keys.
+        values = self.get_values(view, idx, el, ns, name)
+        if values:
+            keys = [(k, k) for k in values]
+            return (keys, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS)
+
+    def get_references(self, view, value, prefix):
+        """Gets completions for resource references such as `@drawable/icon`.
+
+        Before a `/` is typed, completes resource types of the project.
+        References to resources of another package, such as
+        `@android:drawable/`, are not completed.
         """
-        keys = []
-        for e in list(self.lookup.keys()):
-            if e == key or e.startswith(key + "_"):
-                keys.append(e)
-        return keys
+        m = re.match(r"@\+?(\w+:)?(\w*)(/?)", value)
+        if m is None or m.group(1):
+            return
+        res = resources.get_resources(view)
+        if not m.group(3):
+            keys = [(k, k + "/") for k in res.get_types()]
+        else:
+            keys = [(k, k) for k in res.find(m.group(2), prefix)]
+        return (keys, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS)
+
+    def get_attributes(self, view, idx, el, ns):
+        """Gets attributes of el in namespace ns.
+
+        The `android` namespace is served by the sdk completion index. Custom
+        views, identified by a fully qualified tag, fall back to `View`
+        attributes. Any other namespace, other than `tools`, is served by
+        attributes declared in the project and its library projects.
+        """
+        if ns == "android":
+            attrs = idx.get_attributes(el)
+            if not attrs and "." in el:
+                attrs = idx.get_attributes("View")
+            return attrs
+        if ns in ["tools", "xmlns"]:
+            return []
+        return resources.get_attrs(view).get_attributes(el)
+
+    def get_values(self, view, idx, el, ns, attr):
+        if ns == "android":
+            values = idx.get_values(el, attr)
+            if not values and "." in el:
+                values = idx.get_values("View", attr)
+            return values
+        if ns in ["tools", "xmlns"]:
+            return []
+        return resources.get_attrs(view).get_values(el, attr)
 
     def on_modified(self, view):
         if not self.is_responsible(view):
             return
 
+        xmlcontext.get(view).invalidate(view)
+
         if self.dirty:
             # dont reset dirty here as it prevents final autocompletion in a somewhat
             # bizarre manner.
@@ -96,46 +110,49 @@ class AndroidXmlComplete(sublime_plugin.EventListener):
             return
 
         sel = view.sel()[0]
-        if view.substr(sel.a - 1) in ["<", ":"]:
+        ch = view.substr(sel.a - 1)
+        if ch in ["<", ":"]:
+            view.run_command("auto_complete")
+        elif ch in ["@", "/"] and xmlcontext.get(view).context(view, sel.a).mode == xmlcontext.VALUE:
             view.run_command("auto_complete")
 
-    def is_responsible(self, view):
-        # TODO better check for if this is an android project
-        if view.file_name() and view.file_name().endswith(".xml"):
-            return True
+    def on_selection_modified(self, view):
+        xmlcontext.select(view)
 
-        return False
+    def on_load(self, view):
+        # the view may have been reloaded from disk, start over
+        xmlcontext.discard(view)
 
-    def load_widgets(self, sdk_dir, platform):
-        self.widgets = {}
-        lines = open(os.path.join(sdk_dir, "platforms", platform, "data/widgets.txt"), "rt").readlines()
-        for line in lines:
-            records = [s.rsplit(".")[-1] for s in line.split(" ")]
-            self.widgets[records[0]] = records[1:]
+    def on_reload(self, view):
+        xmlcontext.discard(view)
 
-    def load_lookup(self):
-        self.lookup = {}  # prevents recursive calls (i guess) due to how things currently are
-        sdk_dir = project.get_sdk_dir()
-        platform = project.get_target_platform()
+    def on_revert(self, view):
+        xmlcontext.discard(view)
 
-        self.load_widgets(sdk_dir, platform)
+    def on_close(self, view):
+        xmlcontext.discard(view)
 
-        els = ET.parse(os.path.join(sdk_dir, "platforms", platform, "data/res/values/attrs.xml")).getroot()
-        self.lookup = {}
+    def is_responsible(self, view):
+        if view.file_name() and view.file_name().endswith(".xml"):
+            return project.get_path(view) is not None
+
+        return False
 
-        for el in els:
-            name = el.attrib.get("name", None)
-            if name is None:
-                continue
-            attrs = {}
 
-            for attr in el.getchildren():
-                attr_name = attr.attrib.pop("name", None)
-                if attr_name is None:
-                    continue
-                options = []
-                for enum in attr.getchildren():
-                    options.append(enum.attrib["name"])
-                attrs[attr_name] = options
+class AndroidBuildCompletionIndexCommand(sublime_plugin.WindowCommand):
+    """Prebuilds on-disk completion indexes for every installed sdk platform.
 
-            self.lookup[name] = attrs
+    Indexes are only written to disk, views load the platform they target
+    on demand so prebuilding doesn't fill memory with every platform.
+    """
+
+    def run(self, force=False):
+        sdk_dir = project.get_sdk_dir()
+        threading.Thread(target=self.build, args=(sdk_dir, force)).start()
+
+    def build(self, sdk_dir, force):
+        platforms = index.get_platforms(sdk_dir)
+        for i, platform in enumerate(platforms):
+            sublime.status_message("Android: indexing {0} ({1}/{2})".format(platform, i + 1, len(platforms)))
+            index.load(sdk_dir, platform, force=force)
+        sublime.status_message("Android: indexed {0} platforms".format(len(platforms)))
@@ -0,0 +1,173 @@
+import json
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+from .util import logger
+
+log = logger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+
+# seconds to wait for a started daemon to report its port
+START_TIMEOUT = 30
+
+# seconds builds skip the daemon after it failed to start, instead of waiting
+# on it again. Changing the daemon command gets a new daemon tried right away.
+START_RETRY = 300
+
+
+class DaemonError(Exception):
+    """Raised when the build daemon can't be reached or breaks protocol."""
+
+
+class BuildDaemon(object):
+    """Client of a long-running build server process for a project.
+
+    Keeping the build tool's JVM warm between builds avoids paying for JVM
+    startup and build file parsing on every build.
+
+    The daemon is started with `cmd` in the project's folder and must print
+    the port it listens on, on localhost, as the first line of its output.
+    Each build is a connection on which the client sends a request followed
+    by a newline:
+
+        {"cmd": ["ant", "debug"], "working_dir": "/path/to/project", "env": {}}
+
+    The daemon replies with frames until the build completes, each starting
+    with a byte for the frame type:
+
+        O <4 byte big endian length> <output bytes>
+        X <4 byte big endian signed exit code>
+
+    and closes the connection after the `X` frame. Closing the connection
+    before then cancels the build.
+
+    Args:
+        cmd: command that starts the daemon, or None to connect to an
+            already running daemon on port, which is useful for testing
+            against a stub server.
+    """
+
+    def __init__(self, cmd=None, working_dir=None, port=None, host=DEFAULT_HOST):
+        self.cmd = cmd
+        self.working_dir = working_dir
+        self.port = port
+        self.host = host
+        self.proc = None
+        self.failed = None  # time the daemon last failed to start
+        self.lock = threading.Lock()
+
+    def alive(self):
+        if self.cmd is None:
+            return True
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        """Starts daemon if it's not running and waits for it to report its port.
+
+        Raises:
+            DaemonError right away if the daemon failed to start within the
+            last START_RETRY seconds.
+        """
+        with self.lock:
+            if self.alive():
+                return
+            if self.failed is not None and time.time() - self.failed < START_RETRY:
+                raise DaemonError("Build daemon failed to start recently")
+            try:
+                self.launch()
+            except DaemonError:
+                self.failed = time.time()
+                raise
+            self.failed = None
+
+    def launch(self):
+        """Starts daemon process and waits for it to report its port."""
+        log.info("Starting build daemon %s in %s", self.cmd, self.working_dir)
+        self.port = None
+        try:
+            self.proc = subprocess.Popen(self.cmd, cwd=self.working_dir, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise DaemonError("Failed to start build daemon: {0}".format(e))
+        ready = threading.Event()
+        threading.Thread(target=self.read_output, args=(self.proc, ready)).start()
+        if not ready.wait(START_TIMEOUT) or self.port is None:
+            self.stop()
+            raise DaemonError("Build daemon did not report its port")
+
+    def read_output(self, proc, ready):
+        """Reads the port from the daemon's first line of output, then logs the rest."""
+        line = proc.stdout.readline()
+        try:
+            self.port = int(line.strip())
+        except ValueError:
+            log.error("Unexpected build daemon output: %r", line)
+        ready.set()
+        for line in iter(proc.stdout.readline, b""):
+            log.debug("daemon: %s", line.decode("utf-8", "replace").rstrip())
+        proc.stdout.close()
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            log.info("Stopping build daemon in %s", self.working_dir)
+            self.proc.terminate()
+        self.proc = None
+
+    def connect(self):
+        if self.cmd is not None:
+            self.start()
+        try:
+            return socket.create_connection((self.host, self.port), 5)
+        except socket.error as e:
+            raise DaemonError("Failed to connect to build daemon: {0}".format(e))
+
+    def build(self, sock, cmd, working_dir, env, on_data):
+        """Sends build request on sock, passing output to on_data as it arrives.
+
+        Returns:
+            int of the build's exit code.
+        """
+        request = {"cmd": cmd, "working_dir": working_dir, "env": env or {}}
+        sock.settimeout(None)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        while True:
+            kind, n = struct.unpack(">cI", read(sock, 5))
+            if kind == b"O":
+                on_data(read(sock, n))
+            elif kind == b"X":
+                return struct.unpack(">i", struct.pack(">I", n))[0]
+            else:
+                raise DaemonError("Unexpected build daemon frame: {0!r}".format(kind))
+
+
+def read(sock, n):
+    """Reads exactly n bytes."""
+    buf = b""
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise DaemonError("Build daemon closed connection")
+        buf += chunk
+    return buf
+
+
+# map (project path, daemon command) to BuildDaemon
+_daemons = {}
+
+
+def get_daemon(working_dir, cmd):
+    key = (working_dir, tuple(cmd))
+    d = _daemons.get(key, None)
+    if d is None:
+        d = _daemons[key] = BuildDaemon(cmd, working_dir)
+    return d
+
+
+def stop_daemons():
+    for d in _daemons.values():
+        d.stop()
+    _daemons.clear()
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import threading
+
+import sublime
+
+from .antfile import PROPERTY_FILES
+from .util import logger
+
+log = logger(__name__)
+
+# map file paths to a tuple of ((mtime, size), content digest), so only files
+# changed since they were last fingerprinted are read again.
+_digests = {}
+
+# map (project path, target) to the fingerprint of the last successful build
+_builds = {}
+
+_lock = threading.Lock()
+
+
+def get_inputs(path, libs):
+    """Gets files and folders that affect the build of a project.
+
+    Args:
+        path: android project path.
+        libs: library project paths relative to path, from project.properties.
+
+    Returns:
+        List of absolute paths, which may not exist.
+    """
+    inputs = [os.path.join(path, "build.xml"), os.path.join(path, "custom_rules.xml")]
+    inputs += [os.path.join(path, name) for name in PROPERTY_FILES]
+    for root in [path] + [os.path.normpath(os.path.join(path, lib)) for lib in libs]:
+        inputs.append(os.path.join(root, "AndroidManifest.xml"))
+        inputs.append(os.path.join(root, "project.properties"))
+        inputs.append(os.path.join(root, "src"))
+        inputs.append(os.path.join(root, "res"))
+        inputs.append(os.path.join(root, "assets"))
+        inputs.append(os.path.join(root, "libs"))
+    return inputs
+
+
+def list_files(inputs):
+    paths = []
+    for p in inputs:
+        if os.path.isfile(p):
+            paths.append(p)
+            continue
+        for dirpath, dirnames, filenames in os.walk(p):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            paths += [os.path.join(dirpath, f) for f in filenames if not f.startswith(".")]
+    return sorted(set(paths))
+
+
+def digest(path):
+    """Gets content digest of path, reusing the last digest if its stat is unchanged.
+
+    Returns:
+        String of hex digest or None if path can't be read.
+    """
+    try:
+        st = os.stat(path)
+        stamp = (st.st_mtime, st.st_size)
+        cached = _digests.get(path, None)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                h.update(chunk)
+    except (IOError, OSError):
+        _digests.pop(path, None)
+        return None
+    _digests[path] = (stamp, h.hexdigest())
+    return h.hexdigest()
+
+
+def compute(path, libs):
+    """Computes fingerprint of the sources of a project and its library projects.
+
+    Returns:
+        String of hex digest.
+    """
+    h = hashlib.sha1()
+    with _lock:
+        for f in list_files(get_inputs(path, libs)):
+            h.update("{0}\0{1}\n".format(f, digest(f)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def compute_async(path, libs, callback):
+    """Computes fingerprint on a worker thread, calling callback with it on the main thread."""
+    def _compute():
+        fp = compute(path, libs)
+        sublime.set_timeout(lambda: callback(fp), 0)
+    threading.Thread(target=_compute).start()
+
+
+def is_up_to_date(path, target, fp):
+    """Checks if the last successful build of target had the same fingerprint.
+
+    A build is never up to date if its output folder has been removed, such
+    as by an `ant clean` run outside of sublime.
+    """
+    if not os.path.isdir(os.path.join(path, "bin")):
+        return False
+    return _builds.get((path, target), None) == fp
+
+
+def record(path, target, fp):
+    """Records fingerprint of a successful build."""
+    log.debug("Recording build of %s %s as %s", path, target, fp)
+    _builds[(path, target)] = fp
+
+
+def forget(path):
+    """Forgets builds of all targets of a project, as any build may change the outputs of others."""
+    for key in list(_builds):
+        if key[0] == path:
+            del _builds[key]
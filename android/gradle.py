@@ -0,0 +1,436 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+
+import sublime
+import sublime_plugin
+
+from . import project
+from .ant import get_devices
+from .util import get_setting, logger
+
+log = logger(__name__)
+
+SETTINGS_SCRIPTS = ["settings.gradle", "settings.gradle.kts"]
+MODULE_SCRIPTS = ["build.gradle", "build.gradle.kts"]
+BUILD_SCRIPTS = SETTINGS_SCRIPTS + MODULE_SCRIPTS + ["gradle.properties"]
+
+# directories never walked when looking for module build scripts
+SKIP_DIRS = set(["build", "src", "gradle", "libs"])
+
+# map gradle root paths to GradleTasks
+_tasks = {}
+_loading = set()
+
+# map directories to a tuple of (scripts found, time checked), where scripts
+# found is SETTINGS_SCRIPTS, MODULE_SCRIPTS or None. Entries expire the same
+# as the android project roots cached by `project.find_root`.
+_script_map = {}
+
+
+def get_scripts(folder, now):
+    """Gets the kind of gradle script in folder, if any.
+
+    Returns:
+        SETTINGS_SCRIPTS, MODULE_SCRIPTS or None.
+    """
+    cached = _script_map.get(folder, None)
+    if cached is not None and now - cached[1] < project.ROOT_MAP_TTL:
+        return cached[0]
+    found = None
+    for names in [SETTINGS_SCRIPTS, MODULE_SCRIPTS]:
+        if any(os.path.isfile(os.path.join(folder, name)) for name in names):
+            found = names
+            break
+    if len(_script_map) >= project.ROOT_MAP_MAX:
+        _script_map.clear()
+    _script_map[folder] = (found, now)
+    return found
+
+
+def find_root(folder):
+    """Traverses upwards from folder to locate the root of a gradle build.
+
+    The root is the outermost directory with a settings script, so modules of
+    a multi-module build resolve to the same root, otherwise the nearest
+    directory with a build script. Scripts found in each directory are
+    cached so repeated lookups, such as from `is_visible`, don't touch the
+    filesystem.
+
+    Returns:
+        String of gradle root or None if not found.
+    """
+    now = time.time()
+    root = None
+    while True:
+        found = get_scripts(folder, now)
+        if found is SETTINGS_SCRIPTS:
+            root = folder
+        elif root is None and found is MODULE_SCRIPTS:
+            root = folder
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return root
+        folder = parent
+
+
+def get_root(view=None):
+    """Gets gradle root of a view, falling back to the folders of its window.
+
+    Returns:
+        String of gradle root or None.
+    """
+    if view is None:
+        view = sublime.active_window().active_view()
+    if view is not None and view.file_name():
+        root = find_root(os.path.dirname(os.path.abspath(view.file_name())))
+        if root is not None:
+            return root
+    window = view.window() if view is not None else None
+    for folder in (window or sublime.active_window()).folders():
+        root = find_root(folder)
+        if root is not None:
+            return root
+    return None
+
+
+def exists():
+    return get_root() is not None
+
+
+def get_gradle(root):
+    """Gets the gradle wrapper of root if there is one, otherwise the gradle on PATH."""
+    wrapper = os.path.join(root, "gradlew.bat" if os.name == "nt" else "gradlew")
+    if os.path.isfile(wrapper):
+        return wrapper
+    return "gradle"
+
+
+def get_cmd(root, *args):
+    """Gets command running gradle with args, always reusing the gradle daemon."""
+    return [get_gradle(root), "--daemon"] + list(args)
+
+
+def get_sdk_dir(root):
+    """Gets sdk dir from settings, the build's local.properties or the environment."""
+    sdk_dir = get_setting("sublimeandroid_sdk_dir", "")
+    if sdk_dir:
+        return sdk_dir
+    local = os.path.join(root, "local.properties")
+    if os.path.isfile(local):
+        sdk_dir = project.parse_properties(local).get("sdk.dir", None)
+        if sdk_dir:
+            return sdk_dir
+    return os.environ.get("ANDROID_HOME", os.environ.get("ANDROID_SDK_ROOT", None))
+
+
+def get_adb(root):
+    sdk_dir = get_sdk_dir(root)
+    if sdk_dir is None:
+        return "adb"
+    return os.path.join(sdk_dir, "platform-tools", "adb")
+
+
+def get_modules(root):
+    """Gets root and each directory below it with a build script.
+
+    Returns:
+        List of absolute paths.
+    """
+    modules = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if "build.gradle" in filenames or "build.gradle.kts" in filenames:
+            modules.append(dirpath)
+        dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS and not d.startswith(".")]
+    return modules
+
+
+def stat_scripts(root):
+    """Gets mtime of every build script of a gradle build.
+
+    Returns:
+        Dict of path to mtime.
+    """
+    stamps = {}
+    for folder in [root] + get_modules(root):
+        for name in BUILD_SCRIPTS:
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                stamps[path] = os.path.getmtime(path)
+    return stamps
+
+
+def parse_tasks(output):
+    """Parses output of `gradle tasks --all`.
+
+    Returns:
+        Dict of task names to descriptions.
+    """
+    found = {}
+    for line in output.splitlines():
+        m = re.match(r"([\w:.-]+)( - (.*))?$", line.strip())
+        if m is None or set(m.group(1)) == set("-"):
+            continue
+        # skip section headers such as `Build tasks` that lack a description
+        if m.group(2) is None and ":" not in m.group(1) and not re.match(r"[a-z]", m.group(1)):
+            continue
+        found[m.group(1)] = (m.group(3) or "")[:100]
+    return found
+
+
+def get_cache_path(root):
+    key = hashlib.sha1(os.path.abspath(root).encode("utf-8")).hexdigest()[:12]
+    folder = os.path.join(sublime.cache_path(), "SublimeAndroid", "gradle")
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return os.path.join(folder, "{0}.json".format(key))
+
+
+class GradleTasks(object):
+    """Tasks of a gradle build, cached until any build script changes.
+
+    Running `gradle tasks` configures every module and takes a while even
+    with a warm daemon, so discovered tasks are also saved to disk.
+    """
+
+    def __init__(self, root, stamps, tasks):
+        self.root = root
+        self.stamps = stamps
+        self.tasks = tasks
+
+    def is_fresh(self):
+        return self.stamps == stat_scripts(self.root)
+
+    def save(self):
+        with open(get_cache_path(self.root), "wt") as f:
+            json.dump({"root": self.root, "stamps": self.stamps, "tasks": self.tasks}, f)
+
+    @classmethod
+    def read(cls, root):
+        path = get_cache_path(root)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rt") as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            log.warn("Discarding unreadable gradle task cache %s: %s", path, e)
+            return None
+        return cls(data["root"], data["stamps"], data["tasks"])
+
+    @classmethod
+    def discover(cls, root):
+        """Runs `gradle tasks` to discover tasks of root."""
+        log.info("Discovering gradle tasks of %s", root)
+        stamps = stat_scripts(root)
+        proc = subprocess.Popen(get_cmd(root, "-q", "tasks", "--all"), cwd=root,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise OSError(err.decode("utf-8", "replace").strip() or "gradle tasks failed")
+        return cls(root, stamps, parse_tasks(out.decode("utf-8", "replace")))
+
+
+def get_tasks(root, callback):
+    """Gets tasks of a gradle build, discovering them in the background if needed.
+
+    callback is called on the main thread with GradleTasks, or None if
+    discovery failed.
+    """
+    cached = _tasks.get(root, None) or GradleTasks.read(root)
+    if cached is not None and cached.is_fresh():
+        _tasks[root] = cached
+        callback(cached)
+        return
+
+    def _discover():
+        result = None
+        try:
+            result = _tasks[root] = GradleTasks.discover(root)
+            result.save()
+        except (IOError, OSError) as e:
+            log.error("Failed to discover gradle tasks of %s: %s", root, e)
+        finally:
+            _loading.discard(root)
+        sublime.set_timeout(lambda: callback(result), 0)
+
+    if root in _loading:
+        return
+    _loading.add(root)
+    sublime.status_message("Android: discovering gradle tasks...")
+    threading.Thread(target=_discover).start()
+
+
+def get_output_dirs(root):
+    """Gets the folders gradle writes APKs to for every module of root.
+
+    Folders are returned whether or not they exist yet, as they are searched
+    when installing once the build has run.
+    """
+    return [os.path.join(m, "build", "outputs", "apk") for m in get_modules(root)]
+
+
+def get_app_module(root):
+    """Gets the module applying the android application plugin.
+
+    Returns:
+        String of module path, root if no module applies the plugin.
+    """
+    for module in get_modules(root):
+        for name in ["build.gradle", "build.gradle.kts"]:
+            path = os.path.join(module, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rt", encoding="utf-8", errors="replace") as f:
+                if re.search(r"com\.android\.application", f.read()):
+                    return module
+    return root
+
+
+def get_package(root):
+    """Gets package of the application module of root.
+
+    The module's applicationId is preferred as the manifest of gradle builds
+    may not declare a package.
+
+    Returns:
+        String of package or None.
+    """
+    module = get_app_module(root)
+    for name in ["build.gradle", "build.gradle.kts"]:
+        path = os.path.join(module, name)
+        if os.path.isfile(path):
+            with open(path, "rt", encoding="utf-8", errors="replace") as f:
+                m = re.search(r"applicationId\s*=?\s*[\"']([\w.]+)[\"']", f.read())
+            if m is not None:
+                return m.group(1)
+    manifest = os.path.join(module, "src", "main", "AndroidManifest.xml")
+    if os.path.isfile(manifest):
+        return project.get_package(manifest)
+    return None
+
+
+def get_activity_main(root):
+    """Gets main activity of the application module of root.
+
+    Returns:
+        String such as `com.example/.MainActivity` or None.
+    """
+    manifest = os.path.join(get_app_module(root), "src", "main", "AndroidManifest.xml")
+    if not os.path.isfile(manifest):
+        return None
+    return project.get_activity_main(manifest, get_package(root))
+
+
+class AndroidGradleBuildCommand(sublime_plugin.WindowCommand):
+    """Command for selecting a gradle task and executing.
+
+    Tasks are discovered with `gradle tasks` and cached until a build script
+    changes. Gradle always runs with its daemon so later builds skip
+    starting and configuring a new JVM.
+    """
+
+    def run(self, task=None, quiet=False):
+        self.root = get_root()
+        if task is not None:
+            self.build(task, quiet=quiet)
+            return
+        get_tasks(self.root, self.show)
+
+    def show(self, found):
+        if found is None:
+            sublime.status_message("Android: failed to discover gradle tasks, see console")
+            return
+        self.names = sorted(found.tasks)
+        options = ["Build, Install, Run"]
+        for name in self.names:
+            options.append("{0} - {1}".format(name, found.tasks[name]))
+        self.window.show_quick_panel(options, self.on_done)
+
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        if picked == 0:
+            self.build("assembleDebug", install_and_run=True)
+        else:
+            self.build(self.names[picked - 1])
+
+    def build(self, task, quiet=False, install_and_run=False):
+        opts = {
+            "cmd": get_cmd(self.root, task),
+            "quiet": quiet,
+            "tag": "build",
+            "working_dir": self.root
+        }
+        self.window.run_command("android_exec", opts)
+
+        if install_and_run:
+            self.window.run_command("android_select_device", {"callbacks": ["android_gradle_install", "android_gradle_run"]})
+
+    def is_visible(self):
+        return exists()
+
+    def is_enabled(self):
+        return exists()
+
+
+class AndroidGradleInstallCommand(sublime_plugin.WindowCommand):
+    """Install the newest APK of a build variant from gradle's build outputs."""
+
+    def run(self, device=None, devices=None, variant="debug"):
+        if device is None and not devices:
+            self.window.run_command("android_select_device", {"callbacks": ["android_gradle_install"], "opts": {"variant": variant}})
+            return
+
+        root = get_root()
+        adb = get_adb(root)
+        step = {
+            "install_from": get_output_dirs(root),
+            "pattern": "*-{0}.apk".format(variant),
+            "package": get_package(root)
+        }
+        for device in get_devices(device, devices):
+            opts = {
+                "adb": {"adb": adb, "device": device, "steps": [step]},
+                "name": "install {0}".format(device),
+                "tag": "install:{0}".format(device),
+                "after": ["build"],
+                "working_dir": root
+            }
+            self.window.run_command("android_exec", opts)
+
+    def is_visible(self):
+        return exists()
+
+
+class AndroidGradleRunCommand(sublime_plugin.WindowCommand):
+    def run(self, device=None, devices=None):
+        if device is None and not devices:
+            self.window.run_command("android_select_device", {"callbacks": ["android_gradle_run"]})
+            return
+
+        root = get_root()
+        adb = get_adb(root)
+        activity = get_setting("sublimeandroid_default_activity", "")
+        if not activity:
+            activity = get_activity_main(root)
+        if not activity:
+            sublime.error_message("Main activity not found, set sublimeandroid_default_activity.")
+            return
+
+        for device in get_devices(device, devices):
+            opts = {
+                "adb": {"adb": adb, "device": device, "steps": [{"shell": ["am", "start", "-n", activity]}]},
+                "name": "run {0}".format(device),
+                "tag": "run:{0}".format(device),
+                "after": ["build", "install:{0}".format(device)],
+                "working_dir": root
+            }
+            self.window.run_command("android_exec", opts)
+
+    def is_visible(self):
+        return exists()
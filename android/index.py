@@ -0,0 +1,437 @@
+import bisect
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from xml.etree import ElementTree as ET
+
+import sublime
+
+from .util import get_setting, logger
+
+log = logger(__name__)
+
+# bump when the layout of CompletionIndex changes so stale pickles are rebuilt.
+INDEX_VERSION = 4
+
+# seconds before loading an index that failed is tried again, such as once
+# its platform has been installed.
+FAILED_RETRY = 30
+
+# seconds between checks of a loaded index against the sdk data files.
+FRESH_CHECK = 10
+
+# completion indexes loaded in memory, those currently loading in the
+# background, the time those that failed to load failed and the time loaded
+# indexes were last found fresh, keyed by (sdk_dir, platform).
+# _indexes is kept in least recently used order.
+_indexes = collections.OrderedDict()
+_loading = {}
+_failed = {}
+_checked = {}
+_lock = threading.Lock()
+
+
+def get_cache_dir():
+    """Gets directory used to store compiled completion indexes.
+
+    Returns:
+        String of absolute path, created if it does not exist.
+    """
+    path = os.path.join(sublime.cache_path(), "SublimeAndroid", "index")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def get_index_path(sdk_dir, platform):
+    """Gets path of the on-disk index for a given sdk dir and platform.
+
+    The sdk dir is hashed into the file name so multiple sdk installs don't
+    overwrite each others indexes.
+    """
+    key = hashlib.sha1(os.path.abspath(sdk_dir).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(get_cache_dir(), "{0}-{1}.pickle".format(platform, key))
+
+
+def get_source_paths(sdk_dir, platform):
+    """Gets the sdk data files a completion index is compiled from."""
+    data = os.path.join(sdk_dir, "platforms", platform, "data")
+    return [
+        os.path.join(data, "res", "values", "attrs.xml"),
+        os.path.join(data, "widgets.txt")
+    ]
+
+
+def stat_sources(paths):
+    """Gets mtime and size of each path for checking if an index is stale.
+
+    Returns:
+        Dict of path to tuple of (mtime, size), or None for missing files.
+    """
+    stats = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats[path] = (st.st_mtime, st.st_size)
+        except OSError:
+            stats[path] = None
+    return stats
+
+
+def get_platforms(sdk_dir):
+    """Gets list of installed platforms that provide completion data."""
+    platforms_dir = os.path.join(sdk_dir, "platforms")
+    if not os.path.isdir(platforms_dir):
+        return []
+    platforms = []
+    for platform in sorted(os.listdir(platforms_dir)):
+        if all(os.path.isfile(p) for p in get_source_paths(sdk_dir, platform)):
+            platforms.append(platform)
+    return platforms
+
+
+class CompletionIndex(object):
+    """Compiled completion data for a single sdk platform.
+
+    Attributes:
+        lookup: dict of attrs.xml element names to a dict of attribute names to
+            a list of enum/flag values.
+        widgets: dict of widget names to a list of parent class names.
+        names: sorted list of lookup keys for prefix searches.
+        folded: sorted list of (lowercase name, name) tuples for case
+            insensitive prefix searches.
+        attributes: dict of tag names to a sorted list of every attribute
+            available to the tag, including those inherited from parents.
+        values: dict of tag names to a dict of attribute names to the list of
+            enum/flag values for the attribute.
+    """
+
+    def __init__(self, sdk_dir, platform, sources, lookup, widgets):
+        self.version = INDEX_VERSION
+        self.sdk_dir = sdk_dir
+        self.platform = platform
+        self.sources = sources
+        self.lookup = lookup
+        self.widgets = widgets
+        self.names = sorted(lookup)
+        self.folded = sorted((name.lower(), name) for name in lookup)
+        self.attributes = {}
+        self.values = {}
+        for tag in set(widgets) | set(lookup):
+            self.flatten(tag)
+        self.size = self.estimate_size()
+
+    def is_fresh(self, sdk_dir, platform):
+        """Checks if index was compiled from the current sdk data files."""
+        if self.version != INDEX_VERSION:
+            return False
+        if self.sdk_dir != sdk_dir or self.platform != platform:
+            return False
+        return self.sources == stat_sources(get_source_paths(sdk_dir, platform))
+
+    def find_tags(self, prefix):
+        """Finds lookup keys starting with prefix, ignoring case.
+
+        Returns:
+            List of strings in sorted order.
+        """
+        prefix = prefix.lower()
+        tags = []
+        i = bisect.bisect_left(self.folded, (prefix,))
+        while i < len(self.folded) and self.folded[i][0].startswith(prefix):
+            tags.append(self.folded[i][1])
+            i += 1
+        return tags
+
+    def match_keys(self, key):
+        """Matches a given key to other versions of the same type.
+
+        The SDK data files segment items based on certain types of groups. For
+        example, `ViewGroup` also has an entry for `ViewGroup_MarginLayout`.
+        We don't want to provide tag completion for `ViewGroup_MarginLayout` as
+        that's not a valid tag, but we do want to be able to lookup all keys
+        that are associated with `ViewGroup`.
+
+        Returns:
+            List of strings where each value maps to self.lookup keys.
+        """
+        keys = []
+        if key in self.lookup:
+            keys.append(key)
+        prefix = key + "_"
+        i = bisect.bisect_left(self.names, prefix)
+        while i < len(self.names) and self.names[i].startswith(prefix):
+            keys.append(self.names[i])
+            i += 1
+        return keys
+
+    def flatten(self, tag):
+        """Resolves all attributes of tag and its parents into a single table.
+
+        Attributes of the tag itself take precedence over those of its parents
+        when both declare values for the same attribute.
+        """
+        names = set()
+        values = {}
+        for parent in [tag] + self.widgets.get(tag, []):
+            for key in self.match_keys(parent):
+                for attr, options in self.lookup[key].items():
+                    names.add(attr)
+                    if options and attr not in values:
+                        values[attr] = options
+        self.attributes[tag] = sorted(names)
+        self.values[tag] = values
+
+    def estimate_size(self):
+        """Estimates memory used by index in bytes.
+
+        This is only meant to be good enough for comparing against the cache
+        budget, counting each string and container entry with a fixed
+        overhead.
+        """
+        overhead = 64
+        size = 0
+        for name, attrs in self.lookup.items():
+            size += len(name) + overhead
+            for attr, options in attrs.items():
+                size += len(attr) + overhead + sum(len(o) + overhead for o in options)
+        for tag, names in self.attributes.items():
+            size += overhead * (len(names) + len(self.values[tag]) + 1)
+        size += overhead * (len(self.names) + 2 * len(self.folded))
+        return size
+
+    def get_attributes(self, tag, prefix=""):
+        """Gets attributes of tag starting with prefix.
+
+        Returns:
+            List of strings in sorted order.
+        """
+        names = self.attributes.get(tag, [])
+        if not prefix:
+            return names
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_left(names, prefix + "\U0010ffff", lo)
+        return names[lo:hi]
+
+    def get_values(self, tag, attr):
+        """Gets enum/flag values of an attribute available to tag.
+
+        Returns:
+            List of strings, empty if attribute takes no enum/flag values.
+        """
+        return self.values.get(tag, {}).get(attr, [])
+
+
+def parse_widgets(path):
+    widgets = {}
+    with open(path, "rt") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            records = [s.rsplit(".")[-1] for s in line.split(" ")]
+            widgets[records[0]] = records[1:]
+    return widgets
+
+
+def parse_attrs(path):
+    lookup = {}
+    for el in ET.parse(path).getroot():
+        name = el.attrib.get("name", None)
+        if name is None:
+            continue
+        attrs = {}
+
+        for attr in list(el):
+            attr_name = attr.attrib.get("name", None)
+            if attr_name is None:
+                continue
+            options = []
+            for enum in list(attr):
+                if "name" in enum.attrib:
+                    options.append(enum.attrib["name"])
+            attrs[attr_name] = options
+
+        lookup[name] = attrs
+    return lookup
+
+
+def build(sdk_dir, platform, progress=None):
+    """Compiles a completion index from the sdk data files.
+
+    Args:
+        progress: optional callable receiving a description of each step.
+
+    Returns:
+        CompletionIndex
+    """
+    progress = progress or (lambda step: None)
+    log.info("Building completion index for %s from %s", platform, sdk_dir)
+    attrs_xml, widgets_txt = get_source_paths(sdk_dir, platform)
+    # stat before parsing so an sdk update while parsing leaves the index stale.
+    sources = stat_sources([attrs_xml, widgets_txt])
+    progress("parsing attrs.xml")
+    lookup = parse_attrs(attrs_xml)
+    progress("parsing widgets.txt")
+    widgets = parse_widgets(widgets_txt)
+    progress("resolving attributes")
+    return CompletionIndex(sdk_dir, platform, sources, lookup, widgets)
+
+
+def save(index):
+    """Writes index to disk.
+
+    The index is written to a unique temporary file first so concurrent
+    saves of the same platform, such as by a prebuild while a view loads
+    it, never interleave and readers never see a partial file.
+    """
+    path = get_index_path(index.sdk_dir, index.platform)
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def read(sdk_dir, platform):
+    """Reads index from disk.
+
+    Returns:
+        CompletionIndex if a fresh index exists on disk, otherwise None.
+    """
+    path = get_index_path(sdk_dir, platform)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            index = pickle.load(f)
+    except Exception as e:
+        log.warn("Discarding unreadable completion index %s: %s", path, e)
+        return None
+    if not isinstance(index, CompletionIndex) or not index.is_fresh(sdk_dir, platform):
+        log.info("Completion index for %s is stale.", platform)
+        return None
+    return index
+
+
+def load(sdk_dir, platform, force=False, progress=None):
+    """Loads completion index from disk, rebuilding when sdk data has changed.
+
+    Returns:
+        CompletionIndex
+    """
+    index = None if force else read(sdk_dir, platform)
+    if index is None:
+        index = build(sdk_dir, platform, progress)
+        if progress is not None:
+            progress("saving")
+        try:
+            save(index)
+        except (IOError, OSError) as e:
+            log.error("Failed to save completion index: %s", e)
+    return index
+
+
+def get(sdk_dir, platform):
+    """Gets a loaded completion index without blocking.
+
+    Starts loading the index in the background if it is not loaded yet. A
+    loaded index is checked against the sdk data files every FRESH_CHECK
+    seconds and rebuilt in the background once they change, answering from
+    the stale index meanwhile.
+
+    Returns:
+        CompletionIndex or None if the index is still loading.
+    """
+    key = (sdk_dir, platform)
+    with _lock:
+        index = _indexes.get(key, None)
+        if index is not None:
+            _indexes.move_to_end(key)
+    if index is None:
+        warm(sdk_dir, platform)
+    elif time.time() - _checked.get(key, 0) >= FRESH_CHECK:
+        _checked[key] = time.time()
+        if not index.is_fresh(sdk_dir, platform):
+            log.info("Completion index for %s is stale, rebuilding.", platform)
+            warm(sdk_dir, platform, reload=True)
+    return index
+
+
+def put(index):
+    """Replaces the loaded index for the index's sdk dir and platform."""
+    key = (index.sdk_dir, index.platform)
+    with _lock:
+        _indexes[key] = index
+        _indexes.move_to_end(key)
+        _checked[key] = time.time()
+        _failed.pop(key, None)
+        evict()
+
+
+def evict():
+    """Drops least recently used indexes until within the memory budget.
+
+    The most recently used index is always kept, even if it alone exceeds
+    the budget. Caller must hold `_lock`.
+    """
+    budget = get_setting("sublimeandroid_completion_cache_mb", 64) * 1024 * 1024
+    total = sum(index.size for index in _indexes.values())
+    while total > budget and len(_indexes) > 1:
+        key, index = _indexes.popitem(last=False)
+        _checked.pop(key, None)
+        total -= index.size
+        log.info("Evicted completion index for %s from %s", key[1], key[0])
+
+
+def warm(sdk_dir, platform, reload=False):
+    """Loads completion index on a worker thread if not already loaded.
+
+    Indexes that failed to load are not tried again for FAILED_RETRY seconds.
+
+    Args:
+        reload: load the index again even if it's loaded, such as when it's stale.
+    """
+    key = (sdk_dir, platform)
+    with _lock:
+        if key in _loading or (key in _indexes and not reload):
+            return
+        if key in _failed and time.time() - _failed[key] < FAILED_RETRY:
+            return
+        _loading[key] = "reading cache"
+    threading.Thread(target=_load_worker, args=(key,)).start()
+    _show_progress(key)
+
+
+def _load_worker(key):
+    def progress(step):
+        _loading[key] = step
+
+    try:
+        put(load(key[0], key[1], progress=progress))
+    except Exception as e:
+        log.error("Failed to load completion index for %s: %s", key[1], e)
+        with _lock:
+            _failed[key] = time.time()
+    finally:
+        with _lock:
+            _loading.pop(key, None)
+
+
+def _show_progress(key, tick=0):
+    step = _loading.get(key, None)
+    if step is None:
+        if key in _failed:
+            sublime.status_message("Android: failed to load completions for {0}".format(key[1]))
+        elif key in _indexes:
+            sublime.status_message("Android: completions ready for {0}".format(key[1]))
+        return
+    sublime.status_message("Android: loading completions for {0}, {1}{2}".format(key[1], step, "." * (tick % 4)))
+    sublime.set_timeout(lambda: _show_progress(key, tick + 1), 250)
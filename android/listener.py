@@ -1,12 +1,20 @@
 import sublime
 import sublime_plugin
 
+from . import adb
+from . import index
 from . import project
+from . import resources
 from . import settings
-from .util import check_settings, get_setting, logger, packagemeta
+from . import tasks
+from .util import check_settings, discard_settings, get_setting, logger, packagemeta
 
 log = logger(__name__)
 
+# map (project path, ant target) to a count of saves requesting an auto build,
+# used to tell if a debounced build was superseded by a later save.
+_auto_builds = {}
+
 
 class AndroidAuto(sublime_plugin.EventListener):
     """EventListener to handle enabled automatic events.
@@ -16,14 +24,25 @@ class AndroidAuto(sublime_plugin.EventListener):
     @project.exists
     def on_load(self, view):
         settings.load(view)
+        self.warm_completions(view)
+        self.warm_devices(view)
 
     @project.exists
     def on_new(self, view):
         settings.load(view)
 
-    @project.exists
     def on_post_save(self, view):
+        project.on_save(view)
+        self.post_save(view)
+
+    def on_close(self, view):
+        project.forget(view)
+        discard_settings(view)
+
+    @project.exists
+    def post_save(self, view):
         settings.load(view)
+        resources.on_save(view)
         self.auto_build(view)
 
     @project.exists
@@ -35,10 +54,51 @@ class AndroidAuto(sublime_plugin.EventListener):
         linter = SublimeLinter.select_linter(view)
         SublimeLinter.queue_linter(linter, view, preemptive=True, event='on_post_save')
 
+    def warm_completions(self, view):
+        """Starts loading xml completions in background before they're needed."""
+        index.warm(project.get_sdk_dir(view), project.get_target_platform(view))
+        resources.get_attrs(view)
+        resources.get_resources(view)
+
+    def warm_devices(self, view):
+        """Starts following attached devices so the device picker opens instantly."""
+        if project.get_sdk_dir(view):
+            adb.get_registry(adb.get_adb(view), retry=False)
+
     @check_settings("sublimeandroid_auto_build")
     def auto_build(self, view):
-        target = get_setting("sublimeandroid_default_ant_target", "debug")
-        sublime.active_window().run_command("android_ant_build", {"target": target, "quiet": True})
+        """Builds project once saves stop arriving for the configured delay.
+
+        Saves of the same project and target during the delay, such as from
+        Save All, collapse into a single build.
+        """
+        target = get_setting("sublimeandroid_default_ant_target", "debug", view=view)
+        key = (project.get_path(view), target)
+        count = _auto_builds[key] = _auto_builds.get(key, 0) + 1
+        delay = get_setting("sublimeandroid_auto_build_delay", 1000, view=view)
+        window = view.window() or sublime.active_window()
+        sublime.set_timeout(lambda: self.start_auto_build(window, key, count, delay), delay)
+
+    def start_auto_build(self, window, key, count, delay):
+        if _auto_builds.get(key, None) != count:
+            return  # a later save restarted the delay
+        # a build, install or run started by hand is neither raced nor
+        # cancelled, the auto build waits until it completes.
+        active = tasks.get_scheduler(window).get_active(key[0])
+        if any(task.tag != "auto-build" for task in active):
+            sublime.set_timeout(lambda: self.start_auto_build(window, key, count, delay), delay)
+            return
+        del _auto_builds[key]
+        # an auto build still running is out of date, cancel it in favor of the
+        # new one. Builds started by hand are tagged `build` and left alone.
+        window.run_command("android_exec", {"kill": True, "tag": "auto-build", "working_dir": key[0]})
+        window.run_command("android_ant_build", {
+            "target": key[1],
+            "quiet": True,
+            "skip_unchanged": True,
+            "tag": "auto-build",
+            "path": key[0]
+        })
 
 
 class AndroidToggleAutoCommand(sublime_plugin.WindowCommand):
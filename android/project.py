@@ -1,107 +1,262 @@
 import os
 import re
+import threading
+import time
 from xml.etree import ElementTree as ET
 
 import sublime
 
-from .util import logger, get_setting, get_xml_attrib
+from .util import find_view, logger, get_setting, get_xml_attrib
 
 log = logger(__name__)
 
-# map views to android project paths
+# map views to android project paths located through sublime project folders,
+# None when no project was found.
 _project_map = {}
 
+# map directories to a tuple of (android project root or None, time checked).
+# Entries are shared by every view of a file in the same tree.
+_root_map = {}
 
-def get_path():
-    """Gets android project path from one of the top level folders in sublime project.
+# seconds before a cached project root is checked against the filesystem again,
+# catching projects created or removed outside of sublime.
+ROOT_MAP_TTL = 10
 
-    TODO there are instances where a project may contain subprojects and
-    even where sublime may be used in a fashion to include multiple top-level
-    folders to show multiple projects. It would be nice to support these cases.
+ROOT_MAP_MAX = 10000
+
+# files that mark a directory as an android project root
+PROJECT_FILES = ["AndroidManifest.xml", "project.properties"]
+
+
+def find_root(folder):
+    """Traverses upwards from folder to locate an android project root.
+
+    Every directory traversed is cached with the result, so later lookups of
+    files anywhere in the same tree, including trees that aren't android
+    projects, don't touch the filesystem.
+
+    Returns:
+        String of project root or None if not found.
+    """
+    now = time.time()
+    visited = []
+    root = None
+    while True:
+        cached = _root_map.get(folder, None)
+        if cached is not None and now - cached[1] < ROOT_MAP_TTL:
+            root = cached[0]
+            break
+        visited.append(folder)
+        if all(os.path.isfile(os.path.join(folder, f)) for f in PROJECT_FILES):
+            root = folder
+            break
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            break
+        folder = parent
+
+    if len(_root_map) + len(visited) > ROOT_MAP_MAX:
+        _root_map.clear()
+    for folder in visited:
+        _root_map[folder] = (root, now)
+    return root
+
+
+class Workspace(object):
+    """Index of every android project under the folders of a sublime window.
+
+    Folders are walked in the background to discover project roots including
+    nested subprojects and library projects, used to pick the project of
+    views without a file.
+    """
+
+    # directories never walked when discovering projects
+    skip_dirs = set(["bin", "gen", "build"])
+
+    # maximum depth below a folder to search for projects
+    max_depth = 8
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.roots = set()
+        self.ready = False
+        self.time = time.time()
+
+    def scan(self):
+        roots = set()
+        for folder in self.folders:
+            base = folder.rstrip(os.sep).count(os.sep)
+            for dirpath, dirnames, filenames in os.walk(folder):
+                if all(f in filenames for f in PROJECT_FILES):
+                    roots.add(dirpath)
+                if dirpath.count(os.sep) - base >= self.max_depth:
+                    dirnames[:] = []
+                else:
+                    dirnames[:] = [d for d in dirnames if d not in self.skip_dirs and not d.startswith(".")]
+        self.roots = roots
+        self.ready = True
+        log.info("Found %s android projects in %s", len(roots), ", ".join(self.folders))
+
+    def get_default(self):
+        """Gets project to use for views without a file.
+
+        Prefers a folder that is itself a project, then the first project
+        discovered within a folder.
+        """
+        for folder in self.folders:
+            if folder in self.roots:
+                return folder
+        for folder in self.folders:
+            for root in sorted(self.roots):
+                if root.startswith(folder + os.sep):
+                    return root
+        return None
+
+
+# map window ids to Workspace
+_workspaces = {}
+
+
+def get_workspace(window):
+    """Gets Workspace of window's folders.
+
+    A workspace is rescanned in the background when the window's folders
+    change or once it's older than ROOT_MAP_TTL, catching projects created
+    or removed outside of sublime.
+
+    Returns:
+        Workspace or None if the workspace has not finished scanning.
+    """
+    if window is None:
+        return None
+    folders = tuple(os.path.abspath(f) for f in window.folders())
+    ws = _workspaces.get(window.id(), None)
+    if ws is None or ws.folders != folders or (ws.ready and time.time() - ws.time >= ROOT_MAP_TTL):
+        stale = ws
+        ws = _workspaces[window.id()] = Workspace(folders)
+        threading.Thread(target=ws.scan).start()
+        if stale is not None and stale.ready:
+            # keep answering from the previous scan while the new one runs
+            return stale
+    return ws if ws.ready else None
+
+
+def invalidate():
+    """Forgets all located project roots."""
+    log.debug("Invalidating project roots")
+    _root_map.clear()
+    _project_map.clear()
+    _workspaces.clear()
+
+
+def forget(view):
+    """Evicts cached project of a closed view."""
+    _project_map.pop(view.id(), None)
+
+
+def on_save(view):
+    """Invalidates project roots when a file marking a project root is saved."""
+    if view.file_name() and os.path.basename(view.file_name()) in PROJECT_FILES:
+        invalidate()
+
+
+def get_path(view=None):
+    """Gets android project path of a view.
+
+    Files traverse upwards to locate the project, answered from the
+    directory cache of `find_root`. Views without a file use the first
+    android project of the window's folders, found by the window's Workspace.
+
+    Args:
+        view: view to locate project for, defaults to the active view.
 
     Returns:
         String pointing to absolute path of android project root.
     """
-    p = get_setting("sublimeandroid_project_path", "")
+    if view is None:
+        view = sublime.active_window().active_view()
+
+    p = get_setting("sublimeandroid_project_path", "", view=view)
     if p:
-        log.debug("Returning project path from settings")
         return p
 
-    view = sublime.active_window().active_view()
+    if view is not None and view.file_name():
+        folder = find_root(os.path.dirname(os.path.abspath(view.file_name())))
+        if folder is not None:
+            return folder
+
+    window = None
+    if view is not None:
+        window = view.window()
+    if window is None:
+        window = sublime.active_window()
+    ws = get_workspace(window)
 
     # check if view has already been mapped to an android project
-    if view is not None and _project_map.get(view.id(), None) is not None:
-        log.debug("Returning cached response for view %s: %s", view.id(), _project_map[view.id()])
+    if view is not None and view.id() in _project_map:
         return _project_map[view.id()]
 
-    # Use active file to traverse upwards and locate project
-    if view is not None and view.file_name():
-        folder = os.path.dirname(view.file_name())
-        while folder != "/":  # TODO fix for windows root path
-            android_manifest = os.path.join(folder, "AndroidManifest.xml")
-            project_properties = os.path.join(folder, "project.properties")
-            if os.path.isfile(android_manifest) and os.path.isfile(project_properties):
-                log.info("Found project from active file %s. %s", view.file_name(), folder)
-                _project_map[view.id()] = folder
-                return folder
-            folder = os.path.abspath(os.path.join(folder, ".."))
-
-    # inspect project folders to locate root android project
-    #
-    # Using sublime project folders has less precedent than the current viewsince this will
-    # simply return the first android project found in the list of folders. This is not
-    # contrained by a `view is None` check as it is meant to run in case the current view
-    # is outside of the sublime project.
-    #
-    # BUG this could be buggy if tests are including in project root but sublime allows you
-    # to add a subfolder of a project folder as another project folder. (phew!)
-    for folder in sublime.active_window().folders():
-        a = os.path.join(folder, "local.properties")
-        b = os.path.join(folder, "project.properties")
-        if os.path.isfile(a) and os.path.isfile(b):
-            log.info("Found project from sublime folder %s.", folder)
-            if view is not None:
-                _project_map[view.id()] = folder
-            return folder
+    found = None
+    if ws is not None:
+        found = ws.get_default()
+    else:
+        # workspace isn't ready, check top-level folders only
+        for folder in window.folders():
+            if all(os.path.isfile(os.path.join(folder, f)) for f in PROJECT_FILES):
+                found = folder
+                break
 
-    log.info("Android project path not found.")
+    if view is not None and ws is not None:
+        _project_map[view.id()] = found
+    if found is None:
+        log.debug("Android project path not found.")
+    return found
 
 
 def exists(fn=None):
     """Determines if current sublime project contains an android project.
 
-    Can also be used as a decorator.
+    Can also be used as a decorator, where the project is located for the
+    view passed to the wrapped function, if any, otherwise the active view.
 
     TODO flukey check
 
     Returns:
         bool
     """
-    def _exists():
-        p = get_path()
-        if p is None:
-            log.debug("Not an android project.")
-            return False
-        log.debug("Is android project based on path %s", p)
-        return True
-
-    def _fn(*args, **kwargs):
-        if _exists():
-            return fn(*args, **kwargs)
-
     if fn is None:
-        return _exists()
+        return get_path() is not None
 
     if hasattr(fn, "__call__"):
+        def _fn(*args, **kwargs):
+            if get_path(find_view(args)) is not None:
+                return fn(*args, **kwargs)
         return _fn
 
     raise Exception("Misuse of decorator `exists`, param of type `{0}` not callable.".format(type(fn)))
 
 
-def get_activity_main():
-    manifest = os.path.join(get_path(), "AndroidManifest.xml")
+def get_package(manifest=None):
+    """Gets package declared by a manifest, defaults to that of the android project."""
+    if manifest is None:
+        manifest = os.path.join(get_path(), "AndroidManifest.xml")
+    return ET.parse(manifest).getroot().attrib.get("package", None)
+
+
+def get_activity_main(manifest=None, package=None):
+    """Gets the activity handling the MAIN action.
+
+    Args:
+        manifest: path of manifest, defaults to that of the android project.
+        package: package of the app, defaults to the package of the manifest.
+
+    Returns:
+        String such as `com.example/.MainActivity` or None.
+    """
+    if manifest is None:
+        manifest = os.path.join(get_path(), "AndroidManifest.xml")
     root = ET.parse(manifest).getroot()
-    package = root.attrib.get("package", "")
+    package = package or root.attrib.get("package", "")
     for activity in root.getiterator("activity"):
         action = activity.find("./intent-filter/action")
         if action is None:
@@ -110,7 +265,7 @@ def get_activity_main():
             return "{0}/{1}".format(package, get_xml_attrib(activity, "name"))
 
 
-def get_classpaths():
+def get_classpaths(view=None):
     """Get java class paths.
 
     Use detected android project to determine absolute paths to
@@ -120,12 +275,12 @@ def get_classpaths():
         list of strings that are absolute paths to standard paths of android
         projects.
     """
-    classpaths = []
-    p = get_path()
+    proj = get_project(view)
+    p = proj.path
     log.debug("Project path %s", p)
-    sdk_dir = get_sdk_dir()
+    sdk_dir = get_sdk_dir(view)
     log.debug("SDK Dir %s", sdk_dir)
-    target_platform = get_target_platform()
+    target_platform = proj.target_platform
     log.debug("Target Platform %s", target_platform)
 
     classpaths = [
@@ -139,7 +294,7 @@ def get_classpaths():
         if not os.path.exists(path):
             log.warn("Classpath does not exist: %s", path)
 
-    for lib in get_android_libs():
+    for lib in proj.android_libs:
         classpaths.append(os.path.join(p, lib, "bin", "classes"))
         classpaths.append(os.path.join(p, lib, "gen"))
         classpaths.append(os.path.join(p, lib, "libs", "*"))
@@ -147,7 +302,7 @@ def get_classpaths():
     return classpaths
 
 
-def get_srcpaths():
+def get_srcpaths(view=None):
     """Get java source paths.
 
     Use detected android project to determine absolute paths to
@@ -156,30 +311,137 @@ def get_srcpaths():
     Returns:
         list of strings that are absolute paths.
     """
-    p = get_path()
-    srcpaths = [os.path.join(p, "src")]
-    for lib in get_android_libs():
-        srcpaths.append(os.path.join(p, lib, "src"))
+    proj = get_project(view)
+    srcpaths = [os.path.join(proj.path, "src")]
+    for lib in proj.android_libs:
+        srcpaths.append(os.path.join(proj.path, lib, "src"))
     return srcpaths
 
 
-def get_sdk_dir():
+def parse_properties(path):
+    """Parses a java properties file such as project.properties.
+
+    Handles comments, `=` and `:` separators, line continuations and escaped
+    characters, which is all android's generated properties files use.
+
+    Returns:
+        Dict of property names to values.
+    """
+    props = {}
+    with open(path, "rt", encoding="utf-8", errors="replace") as f:
+        lines = iter(f.read().splitlines())
+    for line in lines:
+        line = line.lstrip()
+        if not line or line[0] in "#!":
+            continue
+        while re.search(r"(^|[^\\])(\\\\)*\\$", line):
+            line = line[:-1] + next(lines, "").lstrip()
+        m = re.match(r"((?:[^\\=: \t]|\\.)*)[ \t]*[=: \t]?[ \t]*(.*)$", line)
+        key, value = [re.sub(r"\\(.)", r"\1", g) for g in m.groups()]
+        props[key] = value
+    return props
+
+
+class Project(object):
+    """Metadata of an android project.
+
+    Properties files are parsed on first use and only parsed again once their
+    mtime or size changes, so lookups cost a `stat` per file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # name to tuple of ((mtime, size), properties)
+
+    def get_properties(self, name):
+        """Gets properties of a file in the project root, such as `project.properties`.
+
+        Returns:
+            Dict of properties, empty if file does not exist.
+        """
+        path = os.path.join(self.path, name)
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime, st.st_size)
+        except OSError:
+            stamp = None
+        cached = self.files.get(name, None)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        props = {} if stamp is None else parse_properties(path)
+        log.debug("Parsed %s", path)
+        self.files[name] = (stamp, props)
+        return props
+
+    def get_stamp(self):
+        """Gets a value that changes whenever any properties file read so far changes."""
+        for name in list(self.files):
+            self.get_properties(name)
+        return tuple((name, self.files[name][0]) for name in sorted(self.files))
+
+    @property
+    def sdk_dir(self):
+        return self.get_properties("local.properties").get("sdk.dir", None)
+
+    @property
+    def target_platform(self):
+        target = self.get_properties("project.properties").get("target", None)
+        if target is not None and target.startswith("Google"):
+            target = "android-%s" % target.rsplit(":")[-1]
+        return target
+
+    @property
+    def android_libs(self):
+        props = self.get_properties("project.properties")
+        refs = []
+        for key, value in props.items():
+            m = re.match(r"android\.library\.reference\.(\d+)$", key)
+            if m is not None:
+                refs.append((int(m.group(1)), value))
+        return [value for n, value in sorted(refs)]
+
+
+# map android project paths to Project
+_projects = {}
+
+
+def get_project(view=None):
+    """Gets shared Project metadata for the view's android project.
+
+    Returns:
+        Project or None if view is not part of an android project.
+    """
+    p = get_path(view)
+    if p is None:
+        return None
+    return get_project_at(p)
+
+
+def get_project_at(path):
+    """Gets shared Project metadata for the android project at path.
+
+    Returns:
+        Project
+    """
+    proj = _projects.get(path, None)
+    if proj is None:
+        proj = _projects[path] = Project(path)
+    return proj
+
+
+def get_sdk_dir(view=None):
     """Determine path of sdk dir.
 
     Check if setting exists to point to sdk dir, otherwise use
     local.properties of detected android project.
     """
-    sdk_dir = get_setting("sublimeandroid_sdk_dir", "")
+    sdk_dir = get_setting("sublimeandroid_sdk_dir", "", view=view)
     if sdk_dir:
         return sdk_dir
-    p = get_path()
-    f = open(os.path.join(p, "local.properties"))
-    s = f.read()
-    f.close()
-    return re.search("^sdk\.dir=(.*)\n", s, re.MULTILINE).groups()[0]
+    return get_project(view).sdk_dir
 
 
-def get_target_platform():
+def get_target_platform(view=None):
     """Get target platform, such as API 8.
 
     Use detected android project path to read target platform from
@@ -188,24 +450,13 @@ def get_target_platform():
     Returns:
         String of target platform
     """
-    p = get_path()
-    f = open(os.path.join(p, "project.properties"))
-    s = f.read()
-    f.close()
-    target = re.search("^target=(.*)\n", s, re.MULTILINE).groups()[0]
-    if target.startswith("Google"):
-        target = "android-%s" % target.rsplit(":")[-1]
-    return target
+    return get_project(view).target_platform
 
 
-def get_android_libs():
+def get_android_libs(view=None):
     """Gets a list of android libraries used for the project.
 
     Returns:
         List of strings that may be absolute or relative paths.
     """
-    p = get_path()
-    f = open(os.path.join(p, "project.properties"))
-    s = f.read()
-    f.close()
-    return re.findall("^android\.library\.reference.*=(.*)", s, re.MULTILINE)
+    return get_project(view).android_libs
@@ -0,0 +1,393 @@
+import bisect
+import os
+import re
+import threading
+from xml.etree import ElementTree as ET
+
+from . import project
+from .util import logger
+
+log = logger(__name__)
+
+
+def get_res_dirs(view=None):
+    """Gets res dirs of the android project and each of its library projects.
+
+    Returns:
+        List of strings of absolute paths.
+    """
+    p = project.get_path(view)
+    dirs = [os.path.join(p, "res")]
+    for lib in project.get_android_libs(view):
+        dirs.append(os.path.normpath(os.path.join(p, lib, "res")))
+    return dirs
+
+
+def list_files(res_dirs, match_dir, match_file):
+    """Lists files in res dirs where folder and file names match patterns."""
+    paths = []
+    for res in res_dirs:
+        if not os.path.isdir(res):
+            continue
+        for d in os.listdir(res):
+            if re.match(match_dir, d) is None:
+                continue
+            folder = os.path.join(res, d)
+            if not os.path.isdir(folder):
+                continue
+            for f in os.listdir(folder):
+                if re.match(match_file, f) is not None:
+                    paths.append(os.path.join(folder, f))
+    return paths
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def is_current(files, path, mtime):
+    """Checks if a read of path at mtime is still due to be stored in files.
+
+    Scans in the background and saves on the main thread may read the same
+    file at once. A read is dropped if another one already stored it, or if
+    the file has changed since, in which case a newer read stores it.
+    Caller must hold the lock guarding files.
+    """
+    old = files.get(path, None)
+    if old is not None and old[0] == mtime:
+        return False
+    return get_mtime(path) == mtime
+
+
+class ProjectAttrs(object):
+    """Custom attributes declared by a project and its library projects.
+
+    Parses `declare-styleable` and top-level `attr` definitions from
+    `res/values*/attrs*.xml`. Files are tracked individually so a save only
+    re-parses the file that changed.
+
+    Attributes:
+        attributes: dict of styleable names to a sorted list of attribute names.
+            Attributes of `Name_*` styleables are included under `Name`, same
+            as sdk completions.
+        values: dict of styleable names to a dict of attribute names to the
+            list of enum/flag values for the attribute.
+    """
+
+    match_dir = r"values(-.*)?$"
+    match_file = r"attrs.*\.xml$"
+
+    def __init__(self, res_dirs):
+        self.res_dirs = res_dirs
+        self.files = {}
+        self.attributes = {}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def owns(self, path):
+        """Checks if path is a file this index is built from."""
+        folder, name = os.path.split(path)
+        res, d = os.path.split(folder)
+        if re.match(self.match_file, name) is None or re.match(self.match_dir, d) is None:
+            return False
+        return any(os.path.normcase(res) == os.path.normcase(r) for r in self.res_dirs)
+
+    def scan(self):
+        """Parses any files added or changed since the last scan."""
+        paths = list_files(self.res_dirs, self.match_dir, self.match_file)
+        with self.lock:
+            for path in list(self.files):
+                if path not in paths:
+                    del self.files[path]
+        for path in paths:
+            self.update(path, rebuild=False)
+        self.rebuild()
+
+    def update(self, path, rebuild=True):
+        """Re-parses path if it has changed since it was last parsed.
+
+        Returns:
+            bool of whether the file changed.
+        """
+        mtime = get_mtime(path)
+        old = self.files.get(path, None)
+        if mtime is None:
+            with self.lock:
+                changed = self.files.pop(path, None) is not None
+        elif old is not None and old[0] == mtime:
+            return False
+        else:
+            try:
+                parsed = self.parse(path)
+            except (IOError, OSError, ET.ParseError) as e:
+                log.warn("Skipping custom attrs in %s: %s", path, e)
+                return False
+            with self.lock:
+                if not is_current(self.files, path, mtime):
+                    return False
+                self.files[path] = (mtime,) + parsed
+            changed = True
+        if changed and rebuild:
+            self.rebuild()
+        return changed
+
+    def parse(self, path):
+        """Parses attrs file.
+
+        Returns:
+            Tuple of a dict of styleable names to a dict of attribute names to
+            lists of values, and a dict of top-level attr names to lists of values.
+        """
+        styleables = {}
+        attrs = {}
+        for el in ET.parse(path).getroot():
+            name = el.attrib.get("name", None)
+            if name is None:
+                continue
+            if el.tag == "attr":
+                attrs[name] = self.parse_values(el)
+            elif el.tag == "declare-styleable":
+                styleable = {}
+                for attr in el.iter("attr"):
+                    attr_name = attr.attrib.get("name", "")
+                    # skip empty names and framework attrs such as `android:text`
+                    if attr_name and ":" not in attr_name:
+                        styleable[attr_name] = self.parse_values(attr)
+                styleables[name] = styleable
+        return styleables, attrs
+
+    def parse_values(self, attr):
+        return [e.attrib["name"] for e in attr if "name" in e.attrib]
+
+    def rebuild(self):
+        """Merges parsed files into attribute and value tables."""
+        with self.lock:
+            top = {}
+            for mtime, styleables, attrs in self.files.values():
+                top.update(attrs)
+
+            names = {}
+            values = {}
+            for mtime, styleables, attrs in self.files.values():
+                for name, styleable in styleables.items():
+                    tag = name.split("_", 1)[0]
+                    names.setdefault(tag, set()).update(styleable)
+                    tag_values = values.setdefault(tag, {})
+                    for attr, options in styleable.items():
+                        options = options or top.get(attr, [])
+                        if options:
+                            tag_values.setdefault(attr, options)
+
+            self.attributes = dict((tag, sorted(attrs)) for tag, attrs in names.items())
+            self.values = values
+
+    def get_attributes(self, tag):
+        """Gets custom attributes of tag, matched by the tag's class name."""
+        return self.attributes.get(tag.rsplit(".")[-1], [])
+
+    def get_values(self, tag, attr):
+        return self.values.get(tag.rsplit(".")[-1], {}).get(attr, [])
+
+
+# values xml tags that don't share the name of their resource type, None for
+# those that can't be referenced with `@type/name`.
+VALUES_TYPES = {
+    "string-array": "array",
+    "integer-array": "array",
+    "attr": None,
+    "declare-styleable": None,
+    "eat-comment": None,
+    "skip": None,
+}
+
+
+class ProjectResources(object):
+    """Resources of a project and its library projects for `@type/name` values.
+
+    Covers file based resources, such as `res/drawable-hdpi/icon.png`, entries
+    of `res/values*/*.xml` files and ids declared with `@+id/` in any xml
+    resource. Each file's resources are tracked individually so a save only
+    re-reads the file that changed.
+    """
+
+    def __init__(self, res_dirs):
+        self.res_dirs = res_dirs
+        self.files = {}  # path to tuple of (mtime, list of (type, name))
+        self.names = {}  # type to dict of name to count of files declaring it
+        self.sorted = {}  # type to sorted list of names, built on demand
+        self.lock = threading.Lock()
+
+    def owns(self, path):
+        folder = os.path.dirname(path)
+        res = os.path.dirname(folder)
+        return any(os.path.normcase(res) == os.path.normcase(r) for r in self.res_dirs)
+
+    def scan(self):
+        """Reads any files added or changed since the last scan."""
+        paths = list_files(self.res_dirs, r"[a-z]+(-.*)?$", r"[^.]")
+        for path in set(self.files) - set(paths):
+            self.update(path)
+        for path in paths:
+            self.update(path)
+        log.debug("Indexed resources from %s files in %s", len(paths), self.res_dirs)
+
+    def update(self, path):
+        """Re-reads resources of path if it has changed since it was last read.
+
+        Returns:
+            bool of whether the file changed.
+        """
+        mtime = get_mtime(path)
+        old = self.files.get(path, None)
+        if old is not None and old[0] == mtime:
+            return False
+
+        entries = []
+        if mtime is not None:
+            try:
+                entries = self.parse(path)
+            except (IOError, OSError, ET.ParseError) as e:
+                log.warn("Skipping resources in %s: %s", path, e)
+                return False
+
+        with self.lock:
+            if not is_current(self.files, path, mtime):
+                return False
+            # another thread may have updated path since it was checked above
+            old = self.files.get(path, None)
+            if old is not None:
+                self.remove(old[1])
+            if mtime is None:
+                if old is None:
+                    return False
+                del self.files[path]
+            else:
+                self.files[path] = (mtime, entries)
+                self.add(entries)
+        return True
+
+    def add(self, entries):
+        for typ, name in entries:
+            names = self.names.setdefault(typ, {})
+            names[name] = names.get(name, 0) + 1
+            self.sorted.pop(typ, None)
+
+    def remove(self, entries):
+        for typ, name in entries:
+            names = self.names[typ]
+            names[name] -= 1
+            if names[name] == 0:
+                del names[name]
+            self.sorted.pop(typ, None)
+
+    def parse(self, path):
+        """Gets resources declared by a file.
+
+        Returns:
+            List of tuples of (type, name).
+        """
+        d, f = os.path.split(path)
+        typ = os.path.basename(d).split("-", 1)[0]
+        entries = []
+        if typ == "values":
+            if f.endswith(".xml"):
+                entries += self.parse_values(path)
+        else:
+            entries.append((typ, f.split(".", 1)[0]))
+            if f.endswith(".xml"):
+                entries += self.parse_ids(path)
+        return entries
+
+    def parse_values(self, path):
+        entries = []
+        for el in ET.parse(path).getroot():
+            name = el.attrib.get("name", None)
+            if name is None:
+                continue
+            typ = el.attrib.get("type", None) if el.tag == "item" else VALUES_TYPES.get(el.tag, el.tag)
+            if typ is not None:
+                entries.append((typ, name))
+        return entries
+
+    def parse_ids(self, path):
+        with open(path, "rt", encoding="utf-8", errors="replace") as f:
+            return [("id", name) for name in re.findall(r"@\+id/([\w.]+)", f.read())]
+
+    def get_types(self):
+        """Gets resource types that have at least one resource."""
+        with self.lock:
+            return sorted(typ for typ, names in self.names.items() if names)
+
+    def find(self, typ, prefix=""):
+        """Finds resource names of a type starting with prefix.
+
+        Returns:
+            List of strings in sorted order.
+        """
+        with self.lock:
+            names = self.sorted.get(typ, None)
+            if names is None:
+                names = self.sorted[typ] = sorted(self.names.get(typ, {}))
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_left(names, prefix + "\U0010ffff", lo)
+        return names[lo:hi]
+
+
+# project path to ProjectAttrs and ProjectResources
+_attrs = {}
+_resources = {}
+
+
+def get_attrs(view):
+    """Gets custom attributes of the view's project.
+
+    Starts scanning the project in the background the first time it's
+    requested, returning an empty ProjectAttrs until the scan completes.
+    """
+    p = project.get_path(view)
+    attrs = _attrs.get(p, None)
+    if attrs is None:
+        attrs = _attrs[p] = ProjectAttrs(get_res_dirs(view))
+        threading.Thread(target=attrs.scan).start()
+    return attrs
+
+
+def get_resources(view):
+    """Gets resources of the view's project.
+
+    Starts scanning the project in the background the first time it's
+    requested, returning an incomplete ProjectResources until the scan completes.
+    """
+    p = project.get_path(view)
+    res = _resources.get(p, None)
+    if res is None:
+        res = _resources[p] = ProjectResources(get_res_dirs(view))
+        threading.Thread(target=res.scan).start()
+    return res
+
+
+def on_save(view):
+    """Updates project indexes affected by saving view."""
+    p = project.get_path(view)
+    f = view.file_name()
+    if p is None or f is None:
+        return
+
+    if os.path.basename(f) == "project.properties":
+        # library references may have changed, start over on next request
+        _attrs.pop(p, None)
+        _resources.pop(p, None)
+        return
+
+    attrs = _attrs.get(p, None)
+    if attrs is not None and attrs.owns(f):
+        log.debug("Updating custom attrs from %s", f)
+        attrs.update(f)
+
+    res = _resources.get(p, None)
+    if res is not None and res.owns(f):
+        log.debug("Updating resources from %s", f)
+        res.update(f)
@@ -91,11 +91,13 @@ class AndroidCreateProjectListener(sublime_plugin.EventListener):
             log.info(stdout)
             stderr = p.stderr.read()
             log.info(stderr)
+            project.invalidate()
 
 
 class AndroidUpdateProjectCommand(sublime_plugin.WindowCommand):
     def run(self):
         exec_tool(cmd=["android", "update", "project", "-p", project.get_path()], panel=True)
+        project.invalidate()
 
     def is_visible(self):
         return project.exists()
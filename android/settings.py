@@ -1,42 +1,91 @@
 import os
 
+import sublime
 import sublime_plugin
 
 from . import project
-from .util import check_settings, logger, packagemeta
+from .util import check_settings, get_setting, logger, packagemeta
 
 log = logger(__name__)
 
 
+# map android project paths to a tuple of (stamp, dict of setting names to
+# values) computed for views of the project.
+_snapshots = {}
+
+
 @packagemeta.requires("ADBView")
-def load_adbview(settings):
-    settings.set("adb_command", os.path.join(project.get_sdk_dir(), "platform-tools", "adb"))
+def load_adbview(values, view):
+    values["adb_command"] = os.path.join(project.get_sdk_dir(view), "platform-tools", "adb")
 
 
 @packagemeta.requires("SublimeJava")
-def load_sublimejava(settings):
-    settings.set("sublimejava_classpath", project.get_classpaths())
-    settings.set("sublimejava_srcpath", project.get_srcpaths())
+def load_sublimejava(values, view):
+    values["sublimejava_classpath"] = project.get_classpaths(view)
+    values["sublimejava_srcpath"] = project.get_srcpaths(view)
 
 
 @packagemeta.requires("SublimeLinter")
-def load_sublimelinter(settings):
+def load_sublimelinter(values, view):
     java = {
-        "working_directory": project.get_path(),
+        "working_directory": project.get_path(view),
         "lint_args": [
             "-d", "bin/classes",
             "-sourcepath", "src",
-            "-classpath", ":".join(project.get_classpaths()),
+            "-classpath", ":".join(project.get_classpaths(view)),
             "-source", "1.6",
             "-target", "1.6",
             "-Xlint",
             "{filename}"
         ]
     }
-    linter = settings.get("SublimeLinter", {})
-    linter["Java"] = java
-    settings.set("SublimeLinter", linter)
-    disable_sublimelinter_defaults(settings)
+    # merged into the view's existing SublimeLinter settings
+    values["SublimeLinter"] = {"Java": java}
+
+
+def get_snapshot(view):
+    """Gets settings computed for the view's project.
+
+    Settings are computed once per project and only computed again when the
+    project's properties files or sdk dir setting change.
+
+    Returns:
+        Dict of setting names to values.
+    """
+    proj = project.get_project(view)
+    stamp = (proj.get_stamp(), get_setting("sublimeandroid_sdk_dir", "", view=view))
+    cached = _snapshots.get(proj.path, None)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    log.debug("computing settings for project %s", proj.path)
+    values = {}
+    load_adbview(values, view)
+    load_sublimejava(values, view)
+    load_sublimelinter(values, view)
+    # computing reads the properties files, so take the stamp again
+    stamp = (proj.get_stamp(), get_setting("sublimeandroid_sdk_dir", "", view=view))
+    _snapshots[proj.path] = (stamp, values)
+    return values
+
+
+def apply(view, values):
+    """Sets values on view, skipping those the view already has.
+
+    Each set triggers change callbacks of other packages, so settings are
+    only written when they differ. Dict values are merged into the view's
+    existing dict.
+    """
+    settings = view.settings()
+    for name, value in values.items():
+        current = settings.get(name, None)
+        if isinstance(value, dict) and isinstance(current, dict):
+            merged = dict(current)
+            merged.update(value)
+            value = merged
+        if current != value:
+            log.debug("setting %s on view %s", name, view.id())
+            settings.set(name, value)
 
 
 @project.exists
@@ -69,15 +118,14 @@ def load(view):
     """
 
     log.debug("reloading settings based on view for %s.", view.file_name())
-    settings = view.settings()
-    load_adbview(settings)
-    load_sublimejava(settings)
-    load_sublimelinter(settings)
+    apply(view, get_snapshot(view))
+    disable_sublimelinter_defaults(view.settings())
 
 
 class AndroidLoadSettingsCommand(sublime_plugin.WindowCommand):
     def run(self):
-        load(sublime_plugin.active_window().active_view())
+        _snapshots.clear()
+        load(sublime.active_window().active_view())
 
     def is_visible(self):
         return project.exists()
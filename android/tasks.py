@@ -0,0 +1,496 @@
+import fnmatch
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import sublime
+import sublime_plugin
+
+from . import adbclient
+from . import daemon
+from .util import logger
+
+log = logger(__name__)
+
+# task states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Process(object):
+    """Runs a command, reporting merged stdout and stderr to a listener.
+
+    Listeners implement `on_data(proc, data)` and `on_finished(proc)`, which
+    are called from a background thread.
+    """
+
+    def __init__(self, cmd, working_dir, env, listener):
+        self.listener = listener
+        self.start_time = time.time()
+        self.killed = False
+        merged_env = os.environ.copy()
+        merged_env.update(env or {})
+        startupinfo = None
+        if os.name == "nt":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     cwd=working_dir or None, env=merged_env, startupinfo=startupinfo)
+        threading.Thread(target=self.read).start()
+
+    def read(self):
+        fd = self.proc.stdout.fileno()
+        while True:
+            data = os.read(fd, 4096)
+            if not data:
+                break
+            self.listener.on_data(self, data)
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.listener.on_finished(self)
+
+    def kill(self):
+        self.killed = True
+        if self.proc.poll() is None:
+            self.proc.terminate()
+
+    def exit_code(self):
+        return self.proc.poll()
+
+
+class DaemonProcess(object):
+    """Runs a command through a BuildDaemon in place of a Process.
+
+    Falls back to running the command as a Process when the daemon can't be
+    reached or exits before the build completes.
+    """
+
+    def __init__(self, build_daemon, cmd, working_dir, env, listener):
+        self.daemon = build_daemon
+        self.cmd = cmd
+        self.working_dir = working_dir
+        self.env = env
+        self.listener = listener
+        self.start_time = time.time()
+        self.code = None
+        self.killed = False
+        self.sock = None
+        self.fallback = None
+        threading.Thread(target=self.run).start()
+
+    def run(self):
+        try:
+            self.sock = self.daemon.connect()
+            self.code = self.daemon.build(self.sock, self.cmd, self.working_dir, self.env,
+                                          lambda data: self.listener.on_data(self, data))
+        except (daemon.DaemonError, socket.error) as e:
+            if self.killed:
+                self.code = 1
+            else:
+                self.run_fallback(e)
+                return
+        finally:
+            if self.sock is not None:
+                self.sock.close()
+        self.listener.on_finished(self)
+
+    def run_fallback(self, err):
+        log.warn("Build daemon failed, running %s directly: %s", self.cmd, err)
+        self.daemon.stop()
+        self.listener.on_data(self, "[build daemon failed, running directly: {0}]\n".format(err).encode("utf-8"))
+        try:
+            self.fallback = Process(self.cmd, self.working_dir, self.env, self.listener)
+        except OSError as e:
+            self.listener.on_data(self, "{0}\n".format(e).encode("utf-8"))
+            self.code = 1
+            self.listener.on_finished(self)
+
+    def kill(self):
+        self.killed = True
+        if self.fallback is not None:
+            self.fallback.kill()
+        elif self.sock is not None:
+            # closing the connection cancels the build. Shut it down first as
+            # closing alone, while the reader is blocked in recv, doesn't tell
+            # the daemon.
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+
+    def exit_code(self):
+        if self.fallback is not None:
+            return self.fallback.exit_code()
+        return self.code
+
+
+def find_latest(folders, pattern):
+    """Finds the most recently modified file below folders with a name matching pattern.
+
+    Returns:
+        String of path or None if no file matches.
+    """
+    found = []
+    for folder in folders:
+        for dirpath, dirnames, filenames in os.walk(folder):
+            for f in fnmatch.filter(filenames, pattern):
+                path = os.path.join(dirpath, f)
+                found.append((os.path.getmtime(path), path))
+    if not found:
+        return None
+    return max(found)[1]
+
+
+class AdbProcess(object):
+    """Runs adb server requests on a thread in place of a Process.
+
+    Args:
+        request: dict with the path of the `adb` binary, used to start the adb
+            server if needed, a `device` and a list of `steps` run in order.
+            Each step is a dict with either an `install` apk path, an
+            `install_from` list of folders to install the newest apk matching
+            `pattern` from, or a `shell` command list. Apks are looked up when
+            the step runs, so a build scheduled before it has written them.
+            Installs given the apk's `package` are skipped when the same apk
+            is already installed.
+    """
+
+    def __init__(self, request, listener):
+        self.request = request
+        self.listener = listener
+        self.start_time = time.time()
+        self.code = None
+        self.killed = False
+        threading.Thread(target=self.run).start()
+
+    def run(self):
+        client = adbclient.get_client(self.request["adb"])
+        device = self.request["device"]
+        try:
+            for step in self.request["steps"]:
+                if "install_from" in step:
+                    apk = find_latest(step["install_from"], step["pattern"])
+                    if apk is None:
+                        raise adbclient.AdbError("No apk matching {0} in {1}".format(step["pattern"], ", ".join(step["install_from"])))
+                    output = client.install(device, apk, package=step.get("package", None))
+                elif "install" in step:
+                    output = client.install(device, step["install"], package=step.get("package", None))
+                else:
+                    output = client.shell_stream(device, " ".join(step["shell"]), wait=True)
+                for data in output:
+                    if self.killed:
+                        raise adbclient.AdbError("Cancelled")
+                    self.listener.on_data(self, data)
+            self.code = 0
+        except (adbclient.AdbError, socket.error, IOError) as e:
+            self.listener.on_data(self, "{0}\n".format(e).encode("utf-8"))
+            self.code = 1
+        self.listener.on_finished(self)
+
+    def kill(self):
+        self.killed = True
+
+    def exit_code(self):
+        return self.code
+
+
+class Task(object):
+    """A command or adb request run by a Scheduler.
+
+    Args:
+        name: text identifying the task in output.
+        cmd: list of command arguments.
+        adb: adb request, see AdbProcess.
+        daemon: optional command starting a BuildDaemon to run cmd with.
+        tag: identifies the task to tasks submitted later that depend on it,
+            such as `build` or `install:emulator-5554`.
+        quiet: don't show output panel unless the task fails.
+        callback: optional callable receiving the task once it has run.
+    """
+
+    def __init__(self, name, cmd=None, adb=None, daemon=None, working_dir="", env=None, tag=None, quiet=False,
+                 callback=None):
+        self.name = name
+        self.cmd = cmd
+        self.adb = adb
+        self.daemon = daemon
+        self.working_dir = working_dir
+        self.env = env
+        self.tag = tag
+        self.quiet = quiet
+        self.callback = callback
+        self.deps = []
+        self.waits = []  # tasks that must exit first, whatever their result
+        self.state = PENDING
+        self.reason = ""
+        self.proc = None
+        self.end_time = None
+        self.scheduler = None
+        self.output = []  # buffered while another task owns the output panel
+        self.flushed = False
+
+    def key(self):
+        """Gets a value identifying identical tasks."""
+        return json.dumps([self.cmd, self.adb, self.working_dir, self.env], sort_keys=True)
+
+    def is_active(self):
+        """Checks if task is pending or its process hasn't exited yet.
+
+        A task cancelled while running stays active until its process exits.
+        """
+        return self.state == PENDING or (self.proc is not None and self.end_time is None)
+
+    def start(self, scheduler):
+        self.scheduler = scheduler
+        self.state = RUNNING
+        if self.cmd is not None and self.daemon:
+            build_daemon = daemon.get_daemon(self.working_dir, self.daemon)
+            self.proc = DaemonProcess(build_daemon, self.cmd, self.working_dir, self.env, self)
+        elif self.cmd is not None:
+            self.proc = Process(self.cmd, self.working_dir, self.env, self)
+        else:
+            self.proc = AdbProcess(self.adb, self)
+
+    def on_data(self, proc, data):
+        text = data.decode("utf-8", "replace").replace("\r\n", "\n")
+        sublime.set_timeout(lambda: self.scheduler.on_data(self, text), 0)
+
+    def on_finished(self, proc):
+        sublime.set_timeout(lambda: self.scheduler.on_finished(self, proc.exit_code()), 0)
+
+    def elapsed(self):
+        if self.proc is None:
+            return 0
+        return (self.end_time or time.time()) - self.proc.start_time
+
+
+class Scheduler(object):
+    """Runs tasks of a window as their dependencies complete.
+
+    Tasks that don't depend on each other run in parallel. A task fails when
+    it exits non-zero and every task depending on it, directly or not, is
+    cancelled without running; unrelated tasks carry on. Submitting a task
+    identical to one still pending returns the pending one instead.
+
+    Commands of the same working dir, such as two builds of a project, never
+    run at once. Each waits for those submitted before it to exit.
+
+    Output goes to the window's exec panel in one section per task. The
+    first task started streams its output live while tasks running alongside
+    it buffer theirs until it finishes. Once all tasks of a batch complete,
+    a summary of each task's result is written if more than one ran.
+
+    All methods are called from the main thread.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.tasks = []  # tasks of the current batch in submission order
+        self.view = None
+        self.foreground = None
+        self.finished = True
+
+    def busy(self):
+        return any(task.state in [PENDING, RUNNING] for task in self.tasks)
+
+    def find(self, tag, working_dir):
+        """Gets the latest task of the current batch with tag."""
+        for task in reversed(self.tasks):
+            if task.tag == tag and task.working_dir == working_dir:
+                return task
+        return None
+
+    def submit(self, task, after=None):
+        """Schedules task to run once tasks with the tags in after are done.
+
+        Returns:
+            Task, which is an identical pending task if one exists.
+        """
+        key = task.key()
+        for t in self.tasks:
+            if t.state == PENDING and t.key() == key:
+                log.debug("Task %s is already pending", task.name)
+                return t
+
+        if not self.busy():
+            self.start_batch()
+
+        for tag in after or []:
+            dep = self.find(tag, task.working_dir)
+            if dep is not None:
+                task.deps.append(dep)
+        if task.cmd is not None:
+            task.waits = [t for t in self.get_active(task.working_dir) if t.cmd is not None]
+
+        self.tasks.append(task)
+        if not task.quiet:
+            self.show()
+        self.schedule()
+        return task
+
+    def get_active(self, working_dir):
+        """Gets tasks of working_dir that are pending or still running."""
+        return [t for t in self.tasks if t.working_dir == working_dir and t.is_active()]
+
+    def cancel(self, tag=None, working_dir=None):
+        """Cancels pending and running tasks, all of them if no tag is given."""
+        for task in self.tasks:
+            if tag is not None and (task.tag != tag or task.working_dir != working_dir):
+                continue
+            if task.state == PENDING:
+                task.state = CANCELLED
+                task.reason = "cancelled"
+            elif task.state == RUNNING:
+                task.state = CANCELLED
+                task.reason = "cancelled"
+                task.proc.kill()
+        self.schedule()
+
+    def schedule(self):
+        """Starts tasks whose dependencies are done, cancelling those that can't run."""
+        changed = True
+        while changed:
+            changed = False
+            for task in self.tasks:
+                if task.state != PENDING:
+                    continue
+                failed = [d for d in task.deps if d.state in [FAILED, CANCELLED]]
+                if failed:
+                    task.state = CANCELLED
+                    task.reason = "skipped, {0} {1}".format(failed[0].name, failed[0].state)
+                    changed = True
+                elif all(d.state == DONE for d in task.deps) and not any(w.is_active() for w in task.waits):
+                    self.start(task)
+                    changed = True
+        self.promote()
+        if not self.busy():
+            self.finish_batch()
+
+    def start(self, task):
+        log.debug("Starting task %s", task.name)
+        try:
+            task.start(self)
+        except OSError as e:
+            task.state = FAILED
+            task.reason = str(e)
+            task.output.append("{0}\n".format(e))
+            self.show()
+
+    def start_batch(self):
+        self.tasks = []
+        self.foreground = None
+        self.finished = False
+        self.view = self.window.get_output_panel("exec")
+        self.view.settings().set("word_wrap", True)
+
+    def finish_batch(self):
+        if self.finished:
+            return
+        self.finished = True
+        if len(self.tasks) > 1:
+            lines = []
+            for task in self.tasks:
+                result = "passed" if task.state == DONE else task.state
+                if task.reason:
+                    result += " ({0})".format(task.reason)
+                lines.append("{0}: {1}\n".format(task.name, result))
+            self.write("".join(lines))
+
+    def promote(self):
+        """Gives output panel to the earliest started task that hasn't written its output."""
+        while self.foreground is None:
+            waiting = [t for t in self.tasks if t.proc is not None or t.output]
+            waiting = [t for t in waiting if not t.flushed]
+            if not waiting:
+                return
+            task = waiting[0]
+            task.flushed = True
+            if task.working_dir:
+                self.view.settings().set("result_base_dir", task.working_dir)
+            self.write("[{0}]\n{1}".format(task.name, "".join(task.output)))
+            task.output = []
+            if task.state == RUNNING:
+                self.foreground = task
+            else:
+                self.write_footer(task)
+
+    def write_footer(self, task):
+        if task.state == DONE:
+            self.write("[Finished {0} in {1:.1f}s]\n\n".format(task.name, task.elapsed()))
+        elif task.state == FAILED:
+            self.write("[Failed {0}: {1}]\n\n".format(task.name, task.reason))
+        else:
+            self.write("[Cancelled {0}]\n\n".format(task.name))
+
+    def on_data(self, task, text):
+        if task is self.foreground:
+            self.write(text)
+        else:
+            task.output.append(text)
+
+    def on_finished(self, task, code):
+        task.end_time = time.time()
+        if task.state == RUNNING:
+            if code in [0, None]:
+                task.state = DONE
+            else:
+                task.state = FAILED
+                task.reason = "exit code {0}".format(code)
+                self.show()
+        if task is self.foreground:
+            self.write_footer(task)
+            self.foreground = None
+        if task.callback is not None:
+            try:
+                task.callback(task)
+            except Exception as e:
+                log.error("Task %s callback failed: %s", task.name, e)
+        self.schedule()
+
+    def write(self, text):
+        self.view.run_command("append", {"characters": text, "force": True, "scroll_to_end": True})
+
+    def show(self):
+        self.window.run_command("show_panel", {"panel": "output.exec"})
+
+
+# map window ids to Scheduler
+_schedulers = {}
+
+
+def get_scheduler(window):
+    scheduler = _schedulers.get(window.id(), None)
+    if scheduler is None:
+        scheduler = _schedulers[window.id()] = Scheduler(window)
+    return scheduler
+
+
+class AndroidExecCommand(sublime_plugin.WindowCommand):
+    """Submits a task to the window's task Scheduler.
+
+    Args:
+        cmd: list of command arguments to run.
+        adb: adb request to send to the adb server instead, see AdbProcess.
+        name: text identifying task in output, defaults to the command.
+        tag: identifies task to tasks that depend on it.
+        after: list of tags of tasks that must complete before this one runs.
+        kill: cancels all tasks, or those with tag if given.
+    """
+
+    def run(self, cmd=None, adb=None, working_dir="", env=None, quiet=False, name=None, tag=None, after=None, kill=False):
+        scheduler = get_scheduler(self.window)
+        if kill:
+            scheduler.cancel(tag, working_dir)
+            return
+
+        if name is None:
+            name = " ".join(cmd) if cmd is not None else tag
+        task = Task(name, cmd=cmd, adb=adb, working_dir=working_dir, env=env, tag=tag, quiet=quiet)
+        scheduler.submit(task, after)
@@ -7,8 +7,6 @@ import sublime
 
 from .. import packagemeta
 
-import Default.exec as sublime_exec
-
 def logger(name, level=logging.DEBUG):
     sh = logging.StreamHandler()
     sh.setLevel(logging.DEBUG)
@@ -21,32 +19,107 @@ def logger(name, level=logging.DEBUG):
 
 log = logger(__name__)
 
+# package settings, loaded on first use
 _settings = None
 
+# map view ids to a dict of setting names to resolved values, dropped when
+# the view's settings or package settings change. Settings found nowhere are
+# cached as _missing.
+_cache = {}
+_watched = set()
+_missing = object()
+
 
-def get_setting(key, default=None):
+def get_package_settings():
     global _settings
-    try:
-        s = sublime.active_window().active_view().settings()
-        if s.has(key):
-            return s.get(key)
-    except:
-        pass
     if _settings is None:
         _settings = sublime.load_settings("SublimeAndroid.sublime-settings")
-    return _settings.get(key, default)
+        _settings.add_on_change("sublimeandroid", _cache.clear)
+    return _settings
+
+
+def get_active_view():
+    window = sublime.active_window()
+    if window is None:
+        return None
+    return window.active_view()
+
+
+def watch(view):
+    """Drops cached settings of view whenever its settings change.
+
+    View settings include those of the sublime project, so project changes
+    are picked up too.
+    """
+    view_id = view.id()
+    if view_id in _watched:
+        return
+    _watched.add(view_id)
+    view.settings().add_on_change("sublimeandroid", lambda: _cache.pop(view_id, None))
+
+
+def discard_settings(view):
+    """Forgets cached settings of a closed view."""
+    _cache.pop(view.id(), None)
+    _watched.discard(view.id())
+
+
+def get_setting(key, default=None, view=None):
+    """Gets setting of view, falling back to package settings.
+
+    Resolved values are cached until the view's or package settings change,
+    so repeated lookups cost a couple of dict lookups.
+
+    Args:
+        view: view whose settings to check, defaults to the active view.
+    """
+    if view is None:
+        view = get_active_view()
+    if view is None:
+        return get_package_settings().get(key, default)
+
+    values = _cache.get(view.id(), None)
+    if values is None:
+        values = _cache[view.id()] = {}
+        watch(view)
+
+    value = values.get(key, _missing)
+    if value is _missing and key not in values:
+        settings = view.settings()
+        if not settings.has(key):
+            settings = get_package_settings()
+        value = values[key] = settings.get(key) if settings.has(key) else _missing
+    if value is _missing:
+        return default
+    return value
+
+
+def find_view(args):
+    """Gets the first View in args, such as the view passed to EventListener hooks.
+
+    Returns:
+        View or None.
+    """
+    for arg in args:
+        if isinstance(arg, sublime.View):
+            return arg
+    return None
 
 
 def check_settings(*settings):
     """Decorator that checks given settings to affirm they're True.
 
+    Settings are resolved for the view passed to the wrapped function, if
+    any, otherwise the active view.
+
     Returns:
         Wrapped function
     """
     def _decor(fn):
         def _fn(*args, **kwargs):
+            view = find_view(args)
             for setting in settings:
-                if not get_setting(setting):
+                if not get_setting(setting, view=view):
                     return
             return fn(*args, **kwargs)
         return _fn
@@ -68,63 +141,3 @@ class AndroidInstallRequiresCommand(packagemeta.PackageMetaInstallRequiresComman
     def is_visible(self):
         return self.visible()
 
-
-class AndroidExecCommand(sublime_exec.ExecCommand):
-    """Execute lazy serial tasks in background.
-
-    Builds on Default/exec.py to spend less time debugging segfaults with threading in sublime.
-    """
-
-    first_run = True
-    queue = []
-    running = False
-
-    def run(self, *args, **kwargs):
-        if kwargs.get("kill", False):
-            self.running = False
-            super(AndroidExecCommand, self).run(*args, **kwargs)
-            self.handle_queue()
-            return
-
-        # TODO sync against mutex
-        if self.running:
-            self.queue.append((args, kwargs))
-            return
-
-        self.running = True
-
-        # Don't erase previous build results for serial tasks
-        #
-        # BUG the following fn swap is racey for other plugins
-        fn = self.window.get_output_panel
-        if hasattr(self, "output_view"):
-            self.window.get_output_panel = lambda s: self.output_view
-
-        super(AndroidExecCommand, self).run(*args, **kwargs)
-        self.window.get_output_panel = fn
-
-        if self.first_run:
-            self.first_run = False
-            self.window.get_output_panel("exec")
-
-    def on_finished(self, proc):
-        try:
-            super(AndroidExecCommand, self).on_finished(proc)
-        except OSError as e:
-            log.error(e)
-
-        if proc.exit_code() not in [0, None]:
-            self.queue = []
-
-        self.running = False
-        self.handle_queue()
-
-    def handle_queue(self):
-        if self.running:
-            return
-
-        if self.queue:
-            args, kwargs = self.queue.pop(0)
-            self.run(*args, **kwargs)
-        else:
-            self.first_run = True
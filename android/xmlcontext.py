@@ -0,0 +1,259 @@
+import bisect
+import collections
+
+import sublime
+
+from .util import logger
+
+log = logger(__name__)
+
+# tokenizer modes
+TEXT = "text"
+LT = "lt"  # just read `<`
+BANG = "bang"  # `<!`
+BANG_DASH = "bang_dash"  # `<!-`
+COMMENT = "comment"
+DECL = "decl"  # `<?...`, `</...`, `<!DOCTYPE...`, skipped until `>`
+TAG_NAME = "tag_name"
+TAG = "tag"  # inside open tag between attributes
+ATTR_NAME = "attr_name"
+EQUALS = "equals"  # after attribute name, waiting for `=`
+VALUE_START = "value_start"  # after `=`, waiting for quote
+VALUE = "value"
+
+WHITESPACE = " \t\r\n"
+
+# Context of a position in an xml document.
+#
+# mode is one of the tokenizer modes above, tag is the name of the enclosing
+# open tag, attr is the attribute name being typed or whose value is being
+# typed and extra holds the quote character in VALUE mode or count of
+# consecutive dashes in COMMENT mode.
+Context = collections.namedtuple("Context", ["mode", "tag", "attr", "extra"])
+
+START = Context(TEXT, "", "", None)
+
+# commands that edit the view at its selection. Edits by any other command,
+# such as formatters, undo or other plugins, may be anywhere in the view.
+LOCAL_COMMANDS = set(["insert", "left_delete", "right_delete", "paste", "insert_snippet"])
+
+
+def scan(text, state, offset=0):
+    """Advances tokenizer state over text.
+
+    Args:
+        text: string to tokenize.
+        state: Context at the start of text.
+        offset: position of text in the document, used for checkpoints.
+
+    Returns:
+        Tuple of the Context at the end of text and a list of document positions
+        directly following the end of each tag, where the tokenizer is back in
+        TEXT mode.
+    """
+    mode, tag, attr, extra = state
+    checkpoints = []
+    i = 0
+    end = len(text)
+    while i < end:
+        if mode == TEXT:
+            j = text.find("<", i)
+            if j == -1:
+                break
+            mode, tag, attr, extra = LT, "", "", None
+            i = j + 1
+            continue
+        elif mode == VALUE:
+            j = text.find(extra, i)
+            if j == -1:
+                break
+            mode, attr, extra = TAG, "", None
+            i = j + 1
+            continue
+        elif mode == DECL:
+            j = text.find(">", i)
+            if j == -1:
+                break
+            mode = TEXT
+            checkpoints.append(offset + j + 1)
+            i = j + 1
+            continue
+        elif mode == COMMENT and extra == 0:
+            j = text.find("-", i)
+            if j == -1:
+                break
+            i = j
+
+        ch = text[i]
+        i += 1
+        if mode == LT:
+            if ch == "!":
+                mode = BANG
+            elif ch in "?/":
+                mode = DECL
+            elif ch in WHITESPACE or ch in "<>":
+                mode = TEXT
+                if ch == ">":
+                    checkpoints.append(offset + i)
+            else:
+                mode, tag = TAG_NAME, ch
+        elif mode == BANG:
+            mode = BANG_DASH if ch == "-" else DECL
+            if ch == ">":
+                mode = TEXT
+                checkpoints.append(offset + i)
+        elif mode == BANG_DASH:
+            mode, extra = (COMMENT, 0) if ch == "-" else (DECL, None)
+            if ch == ">":
+                mode = TEXT
+                checkpoints.append(offset + i)
+        elif mode == COMMENT:
+            if ch == "-":
+                extra += 1
+            elif ch == ">" and extra >= 2:
+                mode, extra = TEXT, None
+                checkpoints.append(offset + i)
+            else:
+                extra = 0
+        elif ch == ">":
+            mode, attr, extra = TEXT, "", None
+            checkpoints.append(offset + i)
+        elif mode == TAG_NAME:
+            if ch in WHITESPACE or ch == "/":
+                mode = TAG
+            else:
+                tag += ch
+        elif mode == TAG:
+            if ch not in WHITESPACE and ch != "/":
+                mode, attr = ATTR_NAME, ch
+        elif mode == ATTR_NAME:
+            if ch == "=":
+                mode = VALUE_START
+            elif ch in WHITESPACE:
+                mode = EQUALS
+            elif ch == "/":
+                mode, attr = TAG, ""
+            else:
+                attr += ch
+        elif mode == EQUALS:
+            if ch == "=":
+                mode = VALUE_START
+            elif ch == "/":
+                mode, attr = TAG, ""
+            elif ch not in WHITESPACE:
+                mode, attr = ATTR_NAME, ch
+        elif mode == VALUE_START:
+            if ch in "\"'":
+                mode, extra = VALUE, ch
+            elif ch not in WHITESPACE:
+                mode, attr = TAG, ""  # unquoted values are invalid, skip it
+    return Context(mode, tag, attr, extra), checkpoints
+
+
+class Tracker(object):
+    """Incrementally tracks xml context of a view.
+
+    Keeps the tokenizer state at the last queried position along with the
+    position following every tag end seen so far. Edits only discard state
+    after the edited position, so a query near the previous one rescans a
+    handful of characters instead of the document from the start.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.checkpoints = [0]
+        self.pos = 0
+        self.state = START
+        self.change_count = None
+        self.size = None
+        self.sel = None
+
+    def select(self, view):
+        """Records the selection, where the next edit is expected to start.
+
+        Called from `on_selection_modified`.
+        """
+        sel = view.sel()
+        self.sel = min(r.begin() for r in sel) if len(sel) else None
+
+    def invalidate(self, view):
+        """Discards state following the position of the latest edit to view.
+
+        Called from `on_modified`. The edit position is approximated from the
+        selection before and after the edit and the change in buffer size.
+        Everything is discarded unless the edit is confirmed to be the only
+        one since the last update and made at the selection.
+        """
+        sel = view.sel()
+        size = view.size()
+        command = view.command_history(0, True)[0]
+        if (self.size is None or len(sel) == 0 or view.change_count() != self.change_count + 1 or
+                command not in LOCAL_COMMANDS):
+            log.debug("xml context of view %s edited by %s, rescanning", view.id(), command)
+            self.reset()
+            self.select(view)
+            return
+        point = min(r.begin() for r in sel) - max(size - self.size, 0)
+        if self.sel is not None:
+            point = min(point, self.sel)
+        # a checkpoint is valid while the `>` preceding it is untouched
+        del self.checkpoints[bisect.bisect_right(self.checkpoints, point):]
+        if not self.checkpoints:
+            self.checkpoints = [0]
+        if self.pos > point:
+            self.pos = self.checkpoints[-1]
+            self.state = START
+        self.change_count = view.change_count()
+        self.size = size
+        self.select(view)
+
+    def context(self, view, point):
+        """Gets the xml Context at point.
+
+        Returns:
+            Context
+        """
+        if self.change_count != view.change_count():
+            # missed an edit, can't trust anything previously scanned
+            self.reset()
+
+        if point < self.pos:
+            self.pos = self.checkpoints[bisect.bisect_right(self.checkpoints, point) - 1]
+            self.state = START
+
+        if self.pos > 0 and self.state == START and view.substr(self.pos - 1) != ">":
+            log.debug("xml context checkpoint %s is stale, rescanning view %s", self.pos, view.id())
+            self.reset()
+
+        text = view.substr(sublime.Region(self.pos, point))
+        self.state, checkpoints = scan(text, self.state, self.pos)
+        last = self.checkpoints[-1]
+        self.checkpoints.extend(c for c in checkpoints if c > last)
+        self.pos = point
+        self.change_count = view.change_count()
+        self.size = view.size()
+        return self.state
+
+
+_trackers = {}
+
+
+def get(view):
+    """Gets Tracker for view, creating one if needed."""
+    tracker = _trackers.get(view.id(), None)
+    if tracker is None:
+        tracker = _trackers[view.id()] = Tracker()
+    return tracker
+
+
+def select(view):
+    """Records the selection of view if it's tracked."""
+    tracker = _trackers.get(view.id(), None)
+    if tracker is not None:
+        tracker.select(view)
+
+
+def discard(view):
+    _trackers.pop(view.id(), None)